@@ -1,143 +1,640 @@
-from datetime import datetime
+from time import time
+from functools import partial
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from asyncio import Task, CancelledError, create_task, gather, sleep
 from datetime import timezone
 from typing import Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Sequence, Tuple, Union
 
-from aioredis import Redis
-from sqlalchemy.sql import select, insert, update, delete
-from sqlalchemy.ext.asyncio import AsyncSession
-from passlib.context import CryptContext
-from auth.models import Session, datetime_to_unix, unix_to_datetime
-from auth.models import Account, User, VerificationToken, Credential
-from auth.schemas import accounts, users, credentials
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from auth.models import Session, datetime_to_unix, unix_to_datetime, trusted
+from auth.models import Account, User, UserExport, VerificationToken, Credential, SessionAndUser
+from auth.caches import UsersCache, NearCache
+from auth.keys import Keys, KEYS, REDIS_ERRORS, Store, route, partition
+from auth.passwords import PasswordHasher, PASSWORD_HASHER
+from auth.statements import CREATE_USER, CREATE_USER_WITH_ACCOUNT, EXPORT_USERS, GET_USER, GET_USER_BY_EMAIL, GET_USER_BY_ACCOUNT, GET_USERS, GET_USERS_BY_EMAIL, GET_USERS_BY_ACCOUNT, UPDATE_USER, DELETE_USER
+from auth.statements import ADD_ACCOUNT, REMOVE_ACCOUNT, ADD_CREDENTIAL, GET_CREDENTIAL, REMOVE_CREDENTIAL, Statement
+from auth.replicas import Replicas
+from auth.ports import Conflict
+from auth.metrics import instrumented
+from auth.coalescing import coalesced
+
+# Sessions are stored as hashes holding the user id and the absolute expiry, with
+# the key expiring at that same instant. Keys written by earlier versions as plain
+# strings holding the user id are converted in place the first time they are read
+# or updated.
+
+SESSION_GET = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'hash' then
+    return redis.call('HMGET', KEYS[1], 'user_id', 'expires_at')
+end
+if kind == 'string' then
+    local ttl = redis.call('TTL', KEYS[1])
+    if ttl < 0 then
+        return nil
+    end
+    local user_id = redis.call('GET', KEYS[1])
+    local expires_at = tonumber(redis.call('TIME')[1]) + ttl
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'user_id', user_id, 'expires_at', expires_at)
+    redis.call('EXPIREAT', KEYS[1], expires_at)
+    return {user_id, expires_at}
+end
+return nil
+"""
+
+SESSION_ADD = """
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'user_id', ARGV[1], 'expires_at', ARGV[2])
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+"""
+
+SESSION_UPDATE = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'string' then
+    local user_id = redis.call('GET', KEYS[1])
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'user_id', user_id)
+elseif kind ~= 'hash' then
+    return nil
+end
+redis.call('HSET', KEYS[1], 'expires_at', ARGV[1])
+redis.call('EXPIREAT', KEYS[1], ARGV[1])
+return redis.call('HGET', KEYS[1], 'user_id')
+"""
+
+SESSION_DELETE = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+local user_id = nil
+if kind == 'hash' then
+    user_id = redis.call('HGET', KEYS[1], 'user_id')
+elseif kind == 'string' then
+    user_id = redis.call('GET', KEYS[1])
+end
+redis.call('DEL', KEYS[1])
+return user_id
+"""
+
+# Extends many sessions at once, each only if it still exists and the new expiry
+# is later than the stored one, returning the user id of each session extended.
+
+SESSION_EXTEND = """
+local extended = {}
+for index, key in ipairs(KEYS) do
+    extended[index] = false
+    if redis.call('TYPE', key)['ok'] == 'hash' then
+        local expires_at = tonumber(ARGV[index])
+        if tonumber(redis.call('HGET', key, 'expires_at') or 0) < expires_at then
+            redis.call('HSET', key, 'expires_at', expires_at)
+            redis.call('EXPIREAT', key, expires_at)
+            extended[index] = redis.call('HGET', key, 'user_id')
+        end
+    end
+end
+return extended
+"""
+
+# Each user has a sorted set of their session tokens scored by expiry, so their
+# sessions can be found without scanning the keyspace. Expired members are pruned
+# whenever the set is written, and the set itself expires with the last session.
+
+SESSION_INDEX = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', redis.call('TIME')[1])
+for index = 1, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[index + 1], ARGV[index])
+end
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+redis.call('EXPIREAT', KEYS[1], last[2])
+"""
+
+# A verification token is a key holding its expiry, named after its identifier and
+# the token, in a sorted set of the identifier's tokens scored by expiry. Adding a
+# token prunes the expired members, using one removes the key and its member and
+# returns the expiry in a single step, so a token cannot be used twice, and
+# invalidating drops all of an identifier's tokens without scanning. Adding and
+# using take the token key in KEYS. Invalidating only learns the tokens from the
+# index, so it builds their keys from ARGV[1], the prefix they share, which
+# carries the identifier's tag and so the slot of the index it is called with.
+
+VERIFICATION_ADD = """
+local now = tonumber(redis.call('TIME')[1])
+local expires_at = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if expires_at <= now then
+    return 0
+end
+redis.call('SET', KEYS[2], expires_at)
+redis.call('EXPIREAT', KEYS[2], expires_at)
+redis.call('ZADD', KEYS[1], expires_at, ARGV[1])
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+redis.call('EXPIREAT', KEYS[1], last[2])
+return 1
+"""
+
+VERIFICATION_USE = """
+local expires_at = redis.call('GET', KEYS[2])
+if expires_at then
+    redis.call('DEL', KEYS[2])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return expires_at
+"""
+
+VERIFICATION_INVALIDATE = """
+local removed = 0
+for _, token in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    removed = removed + redis.call('DEL', ARGV[1] .. token)
+end
+redis.call('DEL', KEYS[1])
+return removed
+"""
+
+# Rows and values read back from storage were validated when they were written, so
+# the adapters build their models through trusted instead of validating them again.
+
+# register_script hashes the script, and a ring registers it on every node, so
+# each client registers a script once and the adapters, which are built for every
+# request, share it.
+REGISTERED: 'WeakKeyDictionary[Any, Dict[str, Any]]' = WeakKeyDictionary()
+
+def registered(redis: Store, script: str):
+    scripts = REGISTERED.setdefault(redis, {})
+    if script not in scripts:
+        scripts[script] = redis.register_script(script)
+    return scripts[script]
+
+def user_from_row(row: Sequence[Any]) -> User:
+    return trusted(User, {
+        'id': row[0],
+        'name': row[1],
+        'email': row[2],
+        'email_verified_at': row[3],
+        'image_url': row[4]
+    })
+
+def account_from_row(row: Sequence[Any], user_id: int) -> Account:
+    return trusted(Account, {
+        'id': row[0],
+        'type': row[1],
+        'provider': row[2],
+        'user_id': user_id,
+        'refresh_token': row[3],
+        'access_token': row[4],
+        'expires_at': row[5],
+        'id_token': row[6],
+        'scope': row[7],
+        'session_state': row[8],
+        'token_type': row[9]
+    })
+
+def session_from_redis(token: str, user_id: Union[bytes, str], expires_at: int) -> Session:
+    return trusted(Session, {
+        'token': token,
+        'user_id': int(user_id),
+        'expires_at': unix_to_datetime(expires_at, tz=timezone.utc)
+    })
+
+def verification_token_from_redis(token: str, identifier: Union[bytes, str], expires_at: int) -> VerificationToken:
+    return trusted(VerificationToken, {
+        'token': token,
+        'identifier': identifier.decode() if isinstance(identifier, bytes) else identifier,
+        'expires_at': unix_to_datetime(expires_at, tz=timezone.utc)
+    })
 
 class Sessions:
-    def __init__(self, redis: Redis):
+    def __init__(self, redis: Store, cache: Optional[NearCache] = None, keys: Keys = KEYS, sliding: Optional['SlidingExpiry'] = None):
         self.redis = redis
+        self.cache = cache
+        self.keys = keys
+        self.sliding = sliding
+        self.add_script = registered(redis, SESSION_ADD)
+        self.get_script = registered(redis, SESSION_GET)
+        self.update_script = registered(redis, SESSION_UPDATE)
+        self.extend_script = registered(redis, SESSION_EXTEND)
+        self.delete_script = registered(redis, SESSION_DELETE)
+        self.index_script = registered(redis, SESSION_INDEX)
 
+    async def index(self, user_id: Union[bytes, int], expiries: Dict[str, int]):
+        args = [value for token, expires_at in expiries.items() for value in (token, expires_at)]
+        await self.index_script(keys=[self.keys.user_sessions(int(user_id))], args=args)
+
+    @instrumented('sessions.add')
     async def add(self, session: Session) -> Session:
-        expires_in = datetime_to_unix(session.expires_at) - datetime_to_unix(datetime.now())
-        await self.redis.set(session.token, session.user_id, ex=expires_in)
+        if self.cache is not None:
+            self.cache.pop(session.token)
+        key = self.keys.session(session.token)
+        expires_at = datetime_to_unix(session.expires_at)
+        await gather(
+            self.add_script(keys=[key], args=[session.user_id, expires_at]),
+            self.index(session.user_id, {session.token: expires_at})
+        )
+        if self.sliding is not None:
+            self.sliding.forget(session.token)
+            self.sliding.seen(session.token, expires_at)
         return session
 
+    @instrumented('sessions.get')
     async def get(self, token: str) -> Optional[Session]:
-        user_id = await self.redis.get(token)
-        if user_id is None:
+        session = self.cache.get(token) if self.cache is not None else None
+        if session is None:
+            session = await self.load(token)
+        if session is not None and self.sliding is not None:
+            session = self.sliding.current(session)
+        return session
+
+    @coalesced('sessions.get', lambda sessions, token: (id(sessions.redis), sessions.keys.session(token)))
+    async def load(self, token: str) -> Optional[Session]:
+        if self.cache is not None:
+            version = self.cache.version
+        result = await self.get_script(keys=[self.keys.session(token)])
+        if result is None or result[1] is None:
             return None
-        expires_at = await self.redis.ttl(token) + datetime_to_unix(datetime.now())
-        return Session(token=token, user_id=user_id, expires_at=unix_to_datetime(expires_at, tz=timezone.utc))
+        user_id, expires_at = result[0], int(result[1])
+        session = session_from_redis(token, user_id, expires_at)
+        if self.cache is not None:
+            self.cache.set(token, session, version, ttl=expires_at - time())
+        if self.sliding is not None:
+            self.sliding.seen(token, expires_at)
+        return session
+
+    @instrumented('sessions.get_by_user')
+    async def get_by_user(self, user_id: int) -> List[Session]:
+        key = self.keys.user_sessions(user_id)
+        redis = route(self.redis, key)
+        tokens = [token.decode() for token in await redis.zrangebyscore(key, int(time()), '+inf')]
+        found = await gather(*(self.get(token) for token in tokens))
+        sessions = [session for session in found if session is not None and session.user_id == user_id]
+        stale = [token for token, session in zip(tokens, found) if session is None or session.user_id != user_id]
+        if stale:
+            await redis.zrem(key, *stale)
+        return sessions
     
+    @instrumented('sessions.update')
     async def update(self, session: Session) -> Session:
-        await self.redis.expire(session.token, datetime_to_unix(session.expires_at) - datetime_to_unix(datetime.now()))
+        if self.cache is not None:
+            self.cache.pop(session.token)
+        expires_at = datetime_to_unix(session.expires_at)
+        if self.sliding is not None and self.sliding.defer(session.token, expires_at):
+            return session
+        user_id = await self.update_script(keys=[self.keys.session(session.token)], args=[expires_at])
+        if user_id is not None:
+            await self.index(user_id, {session.token: expires_at})
+            if self.sliding is not None:
+                self.sliding.seen(session.token, expires_at)
         return session
 
+    @instrumented('sessions.extend')
+    async def extend(self, expiries: Dict[str, int]) -> int:
+        # Writes a batch of extensions with one script call per group of keys that
+        # can be touched together, then one index update per user.
+        tokens = {self.keys.session(token): token for token in expiries}
+        groups = partition(self.redis, list(tokens))
+        results = await gather(*(
+            self.extend_script(keys=group, args=[expiries[tokens[key]] for key in group]) for group in groups
+        ))
+        users: Dict[int, Dict[str, int]] = {}
+        for group, user_ids in zip(groups, results):
+            for key, user_id in zip(group, user_ids):
+                if user_id is not None:
+                    users.setdefault(int(user_id), {})[tokens[key]] = expiries[tokens[key]]
+        await gather(*(self.index(user_id, extended) for user_id, extended in users.items()))
+        return sum(len(extended) for extended in users.values())
+
+    @instrumented('sessions.delete')
     async def delete(self, token: str):
-        await self.redis.delete(token)
+        if self.cache is not None:
+            self.cache.pop(token)
+        if self.sliding is not None:
+            self.sliding.forget(token)
+        user_id = await self.delete_script(keys=[self.keys.session(token)])
+        if user_id is not None:
+            key = self.keys.user_sessions(int(user_id))
+            await route(self.redis, key).zrem(key, token)
+
+    @instrumented('sessions.delete_by_user')
+    async def delete_by_user(self, user_id: int) -> int:
+        key = self.keys.user_sessions(user_id)
+        redis = route(self.redis, key)
+        tokens = [token.decode() for token in await redis.zrange(key, 0, -1)]
+        for token in tokens:
+            if self.cache is not None:
+                self.cache.pop(token)
+            if self.sliding is not None:
+                self.sliding.forget(token)
+        sessions = [self.keys.session(token) for token in tokens]
+        await gather(*(route(self.redis, session).delete(session) for session in sessions))
+        await redis.delete(key)
+        return len(tokens)
+
+class SlidingExpiry:
+    # Extensions of sessions that will stay alive for more than threshold seconds
+    # are written behind: only the latest one per token is kept here and the
+    # periodic flush writes them in batches. Sessions closer to expiring, or whose
+    # expiry this worker has not seen, are extended right away, and since the
+    # threshold is longer than the flush interval no session lapses waiting for it.
+    # Extensions still pending when a worker dies are lost, which leaves those
+    # sessions with the expiry they had before.
+    def __init__(self, redis: Store, keys: Keys = KEYS, threshold: float = 300, interval: float = 10, max_entries: int = 100000, batch_size: int = 500):
+        if threshold <= interval:
+            raise ValueError("The threshold must be longer than the flush interval")
+        self.sessions = Sessions(redis, keys=keys)
+        self.threshold = threshold
+        self.interval = interval
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.expiries: OrderedDict[str, int] = OrderedDict()
+        self.pending: Dict[str, int] = {}
+        self.task: Optional[Task] = None
+        self.deferred = 0
+        self.flushed = 0
+        self.failures = 0
+
+    def seen(self, token: str, expires_at: int):
+        # A read returns the stored expiry, which is earlier than an extension still
+        # pending, so only extensions the stored expiry already covers are dropped.
+        if self.pending.get(token, expires_at + 1) <= expires_at:
+            del self.pending[token]
+        self.expiries[token] = expires_at
+        self.expiries.move_to_end(token)
+        while len(self.expiries) > self.max_entries:
+            self.pending.pop(self.expiries.popitem(last=False)[0], None)
+
+    def forget(self, token: str):
+        self.expiries.pop(token, None)
+        self.pending.pop(token, None)
+
+    def defer(self, token: str, expires_at: int) -> bool:
+        stored = self.expiries.get(token)
+        if stored is None or stored - time() <= self.threshold:
+            return False
+        if expires_at > max(stored, self.pending.get(token, 0)):
+            self.pending[token] = expires_at
+        self.deferred += 1
+        return True
+
+    def current(self, session: Session) -> Session:
+        expires_at = self.pending.get(session.token)
+        if expires_at is None:
+            return session
+        return session_from_redis(session.token, session.user_id, expires_at)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), self.batch_size):
+            batch = dict(items[start:start + self.batch_size])
+            try:
+                await self.sessions.extend(batch)
+            except (*REDIS_ERRORS, OSError):
+                # Kept for the next flush, unless the session was seen again since.
+                self.failures += 1
+                for token, expires_at in items[start:]:
+                    if token in self.expiries and expires_at > self.pending.get(token, 0):
+                        self.pending[token] = expires_at
+                raise
+            for token, expires_at in batch.items():
+                if token in self.expiries:
+                    self.expiries[token] = max(self.expiries[token], expires_at)
+            self.flushed += len(batch)
+
+    async def run(self):
+        while True:
+            await sleep(self.interval)
+            try:
+                await self.flush()
+            except (*REDIS_ERRORS, OSError):
+                pass
+
+    async def start(self):
+        self.task = create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except CancelledError:
+                pass
+            self.task = None
+        try:
+            await self.flush()
+        except (*REDIS_ERRORS, OSError):
+            pass
+
+Removal = Callable[[], Awaitable[None]]
+
+async def uncache(after_commit: Optional[List[Removal]], *removals: Removal):
+    # Cached users are dropped right away and, inside a transaction, again once it
+    # commits, since until then a read on another connection can still find the
+    # old row and cache it.
+    for removal in removals:
+        await removal()
+    if after_commit is not None:
+        after_commit.extend(removals)
 
 class Users:
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, cache: Optional[UsersCache] = None, after_commit: Optional[List[Removal]] = None, fill: bool = True, primary: Optional[async_sessionmaker[AsyncSession]] = None, reads: Optional[async_sessionmaker[AsyncSession]] = None):
         self.session = session
+        self.cache = cache
+        self.after_commit = after_commit
+        # The cache is shared by every caller, so rows read from a replica, which may
+        # be older than the last write, are returned without being cached.
+        self.fill = fill
+        # Set when reading from a replica: a lookup the replica misses is asked
+        # again of the primary, as the row may have been written moments ago.
+        self.primary = primary
+        # Set in read transactions: single user lookups then run on a session of
+        # their own from reads, and identical ones in flight share one query. Reads
+        # are only shared between sessions bound to the same database, so a caller
+        # pinned to the primary never gets a result read from a replica.
+        self.reads = reads
+        self.source = id(session.bind)
 
+    @instrumented('users.create')
     async def create(self, user: User) -> User:
-        command = insert(users).values(
+        result = await CREATE_USER.execute(self.session,
             name=user.name,
             email=user.email,
             email_verified_at=user.email_verified_at,
             image_url=user.image_url
-        ).returning(
-            users.columns['id'],
-            users.columns['name'],
-            users.columns['email'],
-            users.columns['email_verified_at'],
-            users.columns['image_url']
         )
-        result = await self.session.execute(command)
         row = result.fetchone()
-        return User(
-            id=row[0],
-            name=row[1],
-            email=row[2],
-            email_verified_at=row[3],
-            image_url=row[4]
-        )
+        return user_from_row(row)
     
+    @instrumented('users.create_with_account')
+    async def create_with_account(self, user: User, account: Account) -> User:
+        try:
+            result = await CREATE_USER_WITH_ACCOUNT.execute(self.session,
+                name=user.name,
+                email=user.email,
+                email_verified_at=user.email_verified_at,
+                image_url=user.image_url,
+                account_id=account.id,
+                account_type=account.type,
+                account_provider=account.provider,
+                refresh_token=account.refresh_token,
+                access_token=account.access_token,
+                expires_at=account.expires_at,
+                id_token=account.id_token,
+                scope=account.scope,
+                session_state=account.session_state,
+                token_type=account.token_type
+            )
+        except IntegrityError as error:
+            raise Conflict("User or account already exists") from error
+        return user_from_row(result.fetchone())
+    
+    @instrumented('users.get')
     async def get(self, id: int) -> Optional[User]:
-        command = select(users).where(users.columns['id'] == id)
-        result = await self.session.execute(command)
-        row = result.fetchone()
+        if self.cache is not None:
+            user, generation = await self.cache.lookup(self.cache.id_key(id))
+            if user is not None:
+                return user
+        row = await self.fetchrow(GET_USER, id=id)
         if row is None:
             return None
-        return User(
-            id=row[0],
-            name=row[1],
-            email=row[2],
-            email_verified_at=row[3],
-            image_url=row[4]
-        )
+        user = user_from_row(row)
+        if self.cache is not None and self.fill:
+            await self.cache.add(user, generation=generation)
+        return user
     
+    @instrumented('users.get_by_email')
     async def get_by_email(self, email: str) -> Optional[User]:
-        command = select(users).where(users.columns['email'] == email)
-        result = await self.session.execute(command)
-        row = result.fetchone()
+        if self.cache is not None:
+            user, generation = await self.cache.lookup(self.cache.email_key(email))
+            if user is not None:
+                return user
+        row = await self.fetchrow(GET_USER_BY_EMAIL, email=email)
         if row is None:
             return None
-        return User(
-            id=row[0],
-            name=row[1],
-            email=row[2],
-            email_verified_at=row[3],
-            image_url=row[4]
-        )
+        user = user_from_row(row)
+        if self.cache is not None and self.fill:
+            await self.cache.add(user, generation=generation)
+        return user
     
+    @instrumented('users.get_by_account')
     async def get_by_account(self, provider: str, id: str) -> Optional[User]:
-        command = select(users).join(accounts).where(
-            accounts.columns['account_provider'] == provider,
-            accounts.columns['account_id'] == id
-        )
-        result = await self.session.execute(command)
-        row = result.fetchone()
+        if self.cache is not None:
+            user, generation = await self.cache.lookup(self.cache.account_key(provider, id))
+            if user is not None:
+                return user
+        row = await self.fetchrow(GET_USER_BY_ACCOUNT, provider=provider, account_id=id)
         if row is None:
             return None
-        return User(
-            id=row[0],
-            name=row[1],
-            email=row[2],
-            email_verified_at=row[3],
-            image_url=row[4]
-        )
+        user = user_from_row(row)
+        if self.cache is not None and self.fill:
+            await self.cache.add(user, self.cache.account_key(provider, id), generation=generation)
+        return user
     
+    async def fetchrow(self, statement: Statement, **parameters):
+        if self.reads is not None:
+            row = await self.load(statement, **parameters)
+        else:
+            row = await statement.fetchrow(self.session, **parameters)
+        if row is None and self.primary is not None:
+            async with self.primary() as session:
+                row = await statement.fetchrow(session, **parameters)
+        return row
+
+    @coalesced('users.load', lambda users, statement, **parameters: (users.source, statement.sql, *sorted(parameters.items())))
+    async def load(self, statement: Statement, **parameters):
+        async with self.reads() as session:
+            return await statement.fetchrow(session, **parameters)
+
+    @instrumented('users.get_many')
+    async def get_many(self, ids: List[int]) -> List[Optional[User]]:
+        result = await GET_USERS.fetch(self.session, ids=ids)
+        found = {row[0]: user_from_row(row) for row in result}
+        return [found.get(id) for id in ids]
+
+    @instrumented('users.get_many_by_email')
+    async def get_many_by_email(self, emails: List[str]) -> List[Optional[User]]:
+        result = await GET_USERS_BY_EMAIL.fetch(self.session, emails=emails)
+        found = {row[2]: user_from_row(row) for row in result}
+        return [found.get(email) for email in emails]
+
+    @instrumented('users.get_many_by_account')
+    async def get_many_by_account(self, pairs: List[Tuple[str, str]]) -> List[Optional[User]]:
+        if not pairs:
+            return []
+        result = await GET_USERS_BY_ACCOUNT.fetch(self.session,
+            providers=[provider for provider, _ in pairs],
+            account_ids=[id for _, id in pairs]
+        )
+        found = {(row[5], row[6]): user_from_row(row) for row in result}
+        return [found.get(pair) for pair in pairs]
+
+    async def export(self, after: int = 0, batch_size: int = 1000) -> AsyncIterator[UserExport]:
+        # Rows are fetched batch_size at a time from a server side cursor and each
+        # user is yielded as soon as the rows move past them, so memory stays flat
+        # however large the tables are.
+        result = await self.session.stream(EXPORT_USERS.statement, {'after': after}, execution_options={'yield_per': batch_size})
+        current = None
+        async for row in result:
+            if current is None or current.id != row[0]:
+                if current is not None:
+                    yield current
+                current = trusted(UserExport, {**user_from_row(row).__dict__, 'accounts': []})
+            if row[5] is not None:
+                current.accounts.append(account_from_row(row[5:], row[0]))
+        if current is not None:
+            yield current
+
+    @instrumented('users.update')
     async def update(self, user: User) -> User:
-        command = update(users).where(users.columns['id'] == user.id).values(
+        result = await UPDATE_USER.execute(self.session,
+            user_id=user.id,
             name=user.name,
             email=user.email,
             email_verified_at=user.email_verified_at,
             image_url=user.image_url
-        ).returning(
-            users.columns['id'],
-            users.columns['name'],
-            users.columns['email'],
-            users.columns['email_verified_at'],
-            users.columns['image_url']
         )
-        result = await self.session.execute(command)
         row = result.fetchone()
-        return User(
-            id=row[0],
-            name=row[1],
-            email=row[2],
-            email_verified_at=row[3],
-            image_url=row[4]
-        )
+        if self.cache is not None:
+            await uncache(self.after_commit, partial(self.cache.remove, user.id))
+        return user_from_row(row)
     
+    @instrumented('users.delete')
     async def delete(self, id: int):
-        command = delete(users).where(users.columns['id'] == id)
-        await self.session.execute(command)
+        await DELETE_USER.execute(self.session, id=id)
+        if self.cache is not None:
+            await uncache(self.after_commit, partial(self.cache.remove, id))
+
+class SessionsAndUsers:
+    def __init__(self, redis: Store, session: AsyncSession, cache: Optional[UsersCache] = None, sessions_cache: Optional[NearCache] = None, keys: Keys = KEYS, sessions: Optional[Sessions] = None, fill: bool = True, primary: Optional[async_sessionmaker[AsyncSession]] = None, reads: Optional[async_sessionmaker[AsyncSession]] = None):
+        self.session = session
+        self.sessions = sessions if sessions is not None else Sessions(redis, sessions_cache, keys)
+        self.users = Users(session, cache, fill=fill, primary=primary, reads=reads)
+
+    @instrumented('sessions_and_users.get')
+    async def get(self, token: str) -> Optional[SessionAndUser]:
+        # The database connection is checked out while Redis resolves the token,
+        # so the user query can be sent as soon as the user id is known. When users
+        # are read on sessions of their own the transaction's is never used.
+        if self.users.reads is not None:
+            session = await self.sessions.get(token)
+        else:
+            session, _ = await gather(self.sessions.get(token), self.session.connection())
+        if session is None:
+            return None
+        user = await self.users.get(session.user_id)
+        if user is None:
+            return None
+        return trusted(SessionAndUser, {'session': session, 'user': user})
 
 class Accounts:
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, cache: Optional[UsersCache] = None, after_commit: Optional[List[Removal]] = None):
         self.session = session
+        self.cache = cache
+        self.after_commit = after_commit
 
+    @instrumented('accounts.add')
     async def add(self, account: Account) -> Account:
-        command = insert(accounts).values(
+        await ADD_ACCOUNT.execute(self.session,
             account_id=account.id,
             account_type=account.type,
             account_provider=account.provider,
@@ -150,67 +647,150 @@ class Accounts:
             token_type=account.token_type,
             user_id=account.user_id
         )
-        await self.session.execute(command)
+        if self.cache is not None:
+            await uncache(self.after_commit,
+                partial(self.cache.remove, account.user_id),
+                partial(self.cache.remove_account, account.provider, account.id)
+            )
         return account
 
+    @instrumented('accounts.remove')
     async def remove(self, provider: str, id: str):
-        command = delete(accounts).where(
-            accounts.columns['account_provider'] == provider,
-            accounts.columns['account_id'] == id
-        )
-        await self.session.execute(command)
+        await REMOVE_ACCOUNT.execute(self.session, provider=provider, account_id=id)
+        if self.cache is not None:
+            await uncache(self.after_commit, partial(self.cache.remove_account, provider, id))
 
 
 class VerificationTokens:
-    def __init__(self, redis: Redis):
+    def __init__(self, redis: Store, keys: Keys = KEYS):
         self.redis = redis
+        self.keys = keys
+        self.add_script = registered(redis, VERIFICATION_ADD)
+        self.use_script = registered(redis, VERIFICATION_USE)
+        self.invalidate_script = registered(redis, VERIFICATION_INVALIDATE)
 
+    @instrumented('verification_tokens.add')
     async def add(self, verification_token: VerificationToken) -> VerificationToken:
-        expires_in = datetime_to_unix(verification_token.expires_at) - datetime_to_unix(datetime.now())
-        await self.redis.set(verification_token.token, verification_token.identifier, ex=expires_in)
+        identifier = verification_token.identifier
+        await self.add_script(
+            keys=[self.keys.verification_tokens(identifier), self.keys.verification_token(identifier, verification_token.token)],
+            args=[verification_token.token, datetime_to_unix(verification_token.expires_at)]
+        )
         return verification_token
 
-    async def get(self, token: str) -> Optional[VerificationToken]:
-        identifier = await self.redis.get(token)
-        if identifier is None:
+    @instrumented('verification_tokens.get')
+    @coalesced('verification_tokens.get', lambda tokens, identifier, token: (id(tokens.redis), tokens.keys.verification_token(identifier, token)))
+    async def get(self, identifier: str, token: str) -> Optional[VerificationToken]:
+        key = self.keys.verification_token(identifier, token)
+        expires_at = await route(self.redis, key).get(key)
+        if expires_at is None:
+            return None
+        return verification_token_from_redis(token, identifier, int(expires_at))
+
+    @instrumented('verification_tokens.use')
+    async def use(self, identifier: str, token: str) -> Optional[VerificationToken]:
+        expires_at = await self.use_script(
+            keys=[self.keys.verification_tokens(identifier), self.keys.verification_token(identifier, token)],
+            args=[token]
+        )
+        if expires_at is None:
             return None
-        expires_at = await self.redis.ttl(token) + datetime_to_unix(datetime.now())
-        return VerificationToken(token=token, identifier=identifier, expires_at=unix_to_datetime(expires_at, tz=timezone.utc))
+        return verification_token_from_redis(token, identifier, int(expires_at))
     
+    @instrumented('verification_tokens.update')
     async def update(self, verification_token: VerificationToken):
         await self.add(verification_token)
     
-    async def delete(self, token: str):
-        await self.redis.delete(token)
+    @instrumented('verification_tokens.delete')
+    async def delete(self, identifier: str, token: str):
+        await self.use(identifier, token)
+
+    @instrumented('verification_tokens.invalidate')
+    async def invalidate(self, identifier: str) -> int:
+        return await self.invalidate_script(
+            keys=[self.keys.verification_tokens(identifier)],
+            args=[self.keys.verification_token(identifier, '')]
+        )
 
 
 #TODO:CRYPTOGRAPHY WILL BE A SETTING IN THE FUTURE AND WON'T BE IN THE DATA LAYER. THIS IS JUST FIRST ITERATION.
 #HASHING WILL BE DONE IN THE ENDPOINT IN THE PYDANTIC MODEL SO THE PASSWORD WILL NEVER GET IN THE SERVER. 
 #FOR NOW IS JUST FOR THE SAKE OF DATABASE DESIGN.
 
-CRYPTOGRAPHY_CONTEXT = CryptContext(schemes=['bcrypt'], deprecated='auto')
-
 class Credentials:
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, hasher: PasswordHasher = PASSWORD_HASHER, primary: Optional[async_sessionmaker[AsyncSession]] = None):
         self.session = session
-        self.criptography = CRYPTOGRAPHY_CONTEXT
+        self.hasher = hasher
+        self.primary = primary
 
+    @instrumented('credentials.add')
     async def add(self, credential: Credential):
-        command = insert(credentials).values(
+        await ADD_CREDENTIAL.execute(self.session,
             user_id=credential.user_id,
             username=credential.username,
-            password=self.criptography.hash(credential.password.get_secret_value())
+            password=await self.hasher.hash(credential.password.get_secret_value())
         )
-        await self.session.execute(command)        
 
+    @instrumented('credentials.verify')
     async def verify(self, credential: Credential) -> bool:
-        query = select(credentials).where(
-            credentials.columns['username'] == credential.username,
-        )
-        result = await self.session.execute(query)
-        row = result.fetchone()
-        return self.criptography.verify(credential.password.get_secret_value(), row[3]) if row is not None else False
+        row = await GET_CREDENTIAL.fetchrow(self.session, username=credential.username)
+        if row is None and self.primary is not None:
+            async with self.primary() as session:
+                row = await GET_CREDENTIAL.fetchrow(session, username=credential.username)
+        return await self.hasher.verify(credential.password.get_secret_value(), row[3]) if row is not None else False
     
+    @instrumented('credentials.remove')
     async def remove(self, credential: Credential):
-        command = delete(credentials).where(credentials.columns['username'] == credential.username)
-        await self.session.execute(command)
\ No newline at end of file
+        await REMOVE_CREDENTIAL.execute(self.session, username=credential.username)
+
+
+class Transaction:
+    def __init__(self, session: AsyncSession, storage: 'Storage', replica: bool = False, reads: Optional[async_sessionmaker[AsyncSession]] = None):
+        self.session = session
+        self.after_commit: List[Removal] = []
+        primary = storage.session_maker if replica else None
+        self.users = Users(session, storage.users_cache, self.after_commit, fill=not replica, primary=primary, reads=reads)
+        self.accounts = Accounts(session, storage.users_cache, self.after_commit)
+        self.credentials = Credentials(session, storage.hasher, primary)
+        self.sessions_and_users = SessionsAndUsers(storage.redis, session, storage.users_cache, sessions=storage.sessions, fill=not replica, primary=primary, reads=reads)
+
+    async def commit(self):
+        await self.session.commit()
+        removals = list(self.after_commit)
+        self.after_commit.clear()
+        for removal in removals:
+            await removal()
+
+class Storage:
+    def __init__(self,
+        session_maker: async_sessionmaker[AsyncSession],
+        redis: Store,
+        keys: Keys = KEYS,
+        users_cache: Optional[UsersCache] = None,
+        sessions_cache: Optional[NearCache] = None,
+        hasher: PasswordHasher = PASSWORD_HASHER,
+        replicas: Optional[Replicas] = None,
+        caller: str = '',
+        sliding: Optional[SlidingExpiry] = None
+    ):
+        self.session_maker = session_maker
+        self.redis = redis
+        self.users_cache = users_cache
+        self.hasher = hasher
+        self.replicas = replicas
+        self.caller = caller
+        self.sessions = Sessions(redis, sessions_cache, keys, sliding)
+        self.verification_tokens = VerificationTokens(redis, keys)
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[Transaction]:
+        session_maker = await self.replicas.reader(self.caller) if self.replicas is not None else self.session_maker
+        async with session_maker() as session:
+            yield Transaction(session, self, replica=self.replicas is not None and session_maker is not self.replicas.primary, reads=session_maker)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[Transaction]:
+        if self.replicas is not None:
+            await self.replicas.wrote(self.caller)
+        async with self.session_maker() as session:
+            yield Transaction(session, self)
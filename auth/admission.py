@@ -0,0 +1,192 @@
+from math import ceil
+from time import monotonic
+from asyncio import Semaphore, TimeoutError, wait_for
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from asyncpg import exceptions as asyncpg_exceptions
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
+from auth.keys import REDIS_ERRORS, REDIS_UNAVAILABLE
+from auth.metrics import ADMISSION_REJECTED
+
+# Requests are admitted per route class, each with its own concurrency limit and
+# a short queue, so a spike on one kind of route cannot take every connection.
+# A request that finds the queue full, or waits in it longer than the queue
+# timeout, is turned away with a 503 and a Retry-After right away instead of
+# timing out at the client after the work was done. Each backend also has a
+# circuit breaker, which fails its routes fast while it keeps failing.
+
+SESSIONS = 'sessions'
+SESSION_USERS = 'session_users'
+READS = 'reads'
+WRITES = 'writes'
+PASSWORDS = 'passwords'
+EXPORTS = 'exports'
+
+POSTGRES = 'postgres'
+REDIS = 'redis'
+
+BACKENDS: Dict[str, Tuple[str, ...]] = {
+    SESSIONS: (REDIS,),
+    # Session and user reads resolve the token in Redis, then load the user.
+    SESSION_USERS: (REDIS, POSTGRES),
+    READS: (POSTGRES,),
+    WRITES: (POSTGRES,),
+    PASSWORDS: (POSTGRES,),
+    EXPORTS: (POSTGRES,),
+}
+
+# Errors that mean a backend is unreachable or saturated, as opposed to errors
+# about the request itself such as integrity errors. Prepared statements run on
+# the asyncpg connection, so its own errors are listed next to SQLAlchemy's.
+BACKEND_FAILURES = (
+    OSError, TimeoutError, PoolTimeoutError, OperationalError, InterfaceError,
+    asyncpg_exceptions.PostgresConnectionError, asyncpg_exceptions.InterfaceError,
+    asyncpg_exceptions.InsufficientResourcesError, asyncpg_exceptions.CannotConnectNowError,
+    asyncpg_exceptions.AdminShutdownError, asyncpg_exceptions.CrashShutdownError,
+    *REDIS_UNAVAILABLE
+)
+
+def route_class(method: str, path: str) -> Optional[str]:
+    if path == '/metrics':
+        return None
+    if path == '/users/export':
+        return EXPORTS
+    if path in ('/users/credentials', '/users/credentials/verify') and method == 'POST':
+        return PASSWORDS
+    if path == '/users/sessions/{token}/user':
+        return SESSION_USERS
+    if path.startswith(('/users/sessions', '/users/verification')) or path == '/users/{user_id}/sessions':
+        return SESSIONS
+    if method == 'GET' or path.endswith('/batch'):
+        return READS
+    return WRITES
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, ceil(retry_after))
+
+class Limit:
+    def __init__(self, concurrency: int, queue: Optional[int] = None, queue_timeout: float = 0.1, retry_after: float = 1):
+        self.semaphore = Semaphore(concurrency)
+        self.queue = concurrency if queue is None else queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.waiting = 0
+        self.running = 0
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[None]:
+        if self.semaphore.locked():
+            if self.waiting >= self.queue:
+                raise Overloaded('queue full', self.retry_after)
+            self.waiting += 1
+            try:
+                await wait_for(self.semaphore.acquire(), self.queue_timeout)
+            except TimeoutError:
+                raise Overloaded('queue timeout', self.retry_after)
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+class CircuitBreaker:
+    # Opens after threshold failures in a row and rejects calls for reset_after
+    # seconds. Then a single call is let through: if the backend answers it the
+    # breaker closes, and if it fails the breaker opens again.
+    def __init__(self, threshold: int = 5, reset_after: float = 5):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.opened = 0
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self) -> bool:
+        # Returns whether the caller is the single call let through to probe.
+        if self.opened_at is None:
+            return False
+        remaining = self.opened_at + self.reset_after - monotonic()
+        if remaining > 0 or self.probing:
+            raise Overloaded('circuit open', remaining)
+        self.probing = True
+        return True
+
+    def succeeded(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failed(self):
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                self.opened += 1
+            self.opened_at = monotonic()
+
+
+class Admission:
+    def __init__(self, limits: Dict[str, Limit], breakers: Dict[str, CircuitBreaker], retry_after: float = 1):
+        self.limits = limits
+        self.breakers = breakers
+        self.retry_after = retry_after
+
+    def failed_backend(self, error: BaseException, backends: Tuple[str, ...]) -> str:
+        if isinstance(error, REDIS_ERRORS):
+            return REDIS
+        return POSTGRES if POSTGRES in backends else backends[0]
+
+    @asynccontextmanager
+    async def admit(self, route_class: str) -> AsyncIterator[None]:
+        backends = BACKENDS[route_class]
+        breakers = [self.breakers[backend] for backend in backends if backend in self.breakers]
+        limit = self.limits.get(route_class)
+        probes = []
+        try:
+            for breaker in breakers:
+                if breaker.check():
+                    probes.append(breaker)
+            if limit is None:
+                yield
+            else:
+                async with limit.hold():
+                    yield
+        except Overloaded as overloaded:
+            for breaker in probes:
+                breaker.probing = False
+            ADMISSION_REJECTED.labels(route_class, overloaded.reason).value += 1
+            raise
+        except BACKEND_FAILURES as error:
+            breaker = self.breakers.get(self.failed_backend(error, backends))
+            if breaker is not None:
+                breaker.failed()
+            for breaker in probes:
+                breaker.probing = False
+            ADMISSION_REJECTED.labels(route_class, 'backend failure').value += 1
+            raise Overloaded('backend failure', self.retry_after) from error
+        except Exception:
+            # Any other error, such as a 404, still means the backends answered.
+            for breaker in breakers:
+                breaker.succeeded()
+            raise
+        except BaseException:
+            for breaker in probes:
+                breaker.probing = False
+            raise
+        else:
+            for breaker in breakers:
+                breaker.succeeded()
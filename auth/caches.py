@@ -0,0 +1,243 @@
+from time import monotonic
+from datetime import datetime
+from asyncio import Task, CancelledError, create_task, sleep
+from collections import OrderedDict
+from typing import Any, Optional, List, Tuple
+
+from aioredis import Redis
+from aioredis.exceptions import RedisError
+from pydantic_core import from_json, to_json
+from auth.models import User, trusted
+
+# Users are cached as compact JSON arrays in column order and rebuilt without
+# validation. Entries written as full JSON objects by earlier versions are still
+# read until they expire.
+
+def encode_user(user: User) -> bytes:
+    verified = user.email_verified_at.isoformat() if user.email_verified_at is not None else None
+    return to_json((user.id, user.name, user.email, verified, user.image_url))
+
+def decode_user(data: bytes) -> User:
+    row = from_json(data)
+    if isinstance(row, dict):
+        return User.model_validate(row)
+    return trusted(User, {
+        'id': row[0],
+        'name': row[1],
+        'email': row[2],
+        'email_verified_at': datetime.fromisoformat(row[3]) if row[3] is not None else None,
+        'image_url': row[4]
+    })
+
+# Every removal bumps a generation counter. A lookup reads it along with the
+# entry, and a fill from the database passes it back: if a removal happened in
+# between, the row it read may be the one just changed, and it is not cached.
+USERS_FILL = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+if generation ~= ARGV[1] then
+    return 0
+end
+for index = 3, #KEYS do
+    redis.call('SET', KEYS[index], ARGV[2], 'EX', ARGV[3])
+end
+redis.call('SADD', KEYS[2], unpack(KEYS, 3))
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+class UsersCache:
+    def __init__(self, redis: Redis, ttl: int = 300, prefix: str = 'users'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.fill_script = redis.register_script(USERS_FILL)
+
+    def generation_key(self) -> str:
+        return f'{self.prefix}:generation'
+
+    def id_key(self, id: int) -> str:
+        return f'{self.prefix}:id:{id}'
+
+    def email_key(self, email: str) -> str:
+        return f'{self.prefix}:email:{email}'
+
+    def account_key(self, provider: str, id: str) -> str:
+        return f'{self.prefix}:account:{provider}:{id}'
+
+    def aliases_key(self, id: int) -> str:
+        return f'{self.prefix}:aliases:{id}'
+
+    async def lookup(self, key: str) -> Tuple[Optional[User], bytes]:
+        data, generation = await self.redis.mget(key, self.generation_key())
+        generation = generation if generation is not None else b'0'
+        if data is None:
+            self.misses += 1
+            return None, generation
+        self.hits += 1
+        return decode_user(data), generation
+
+    async def get(self, key: str) -> Optional[User]:
+        user, _ = await self.lookup(key)
+        return user
+
+    async def get_by_id(self, id: int) -> Optional[User]:
+        return await self.get(self.id_key(id))
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        return await self.get(self.email_key(email))
+
+    async def get_by_account(self, provider: str, id: str) -> Optional[User]:
+        return await self.get(self.account_key(provider, id))
+
+    async def add(self, user: User, *keys: str, generation: Optional[bytes] = None) -> bool:
+        # With the generation a lookup returned, the user is only cached if nothing
+        # was removed since.
+        keys = (self.id_key(user.id), self.email_key(user.email), *keys)
+        data = encode_user(user)
+        if generation is not None:
+            return bool(await self.fill_script(keys=[self.generation_key(), self.aliases_key(user.id), *keys], args=[generation, data, self.ttl]))
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.set(key, data, ex=self.ttl)
+            pipeline.sadd(self.aliases_key(user.id), *keys)
+            pipeline.expire(self.aliases_key(user.id), self.ttl)
+            await pipeline.execute()
+        return True
+
+    async def remove(self, id: int):
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.incr(self.generation_key())
+            pipeline.smembers(self.aliases_key(id))
+            _, aliases = await pipeline.execute()
+        await self.redis.delete(self.aliases_key(id), *aliases)
+
+    async def remove_account(self, provider: str, id: str):
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.incr(self.generation_key())
+            pipeline.delete(self.account_key(provider, id))
+            await pipeline.execute()
+
+    @property
+    def hit_ratio(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+class NearCache:
+    def __init__(self, max_entries: int = 10000, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.version = 0
+        self.active = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key) if self.active else None
+        if entry is None or entry[0] <= monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any, version: int, ttl: Optional[float] = None):
+        # A write or invalidation seen since the caller read the version means the
+        # value may already be stale, so it is not cached.
+        if not self.active or version != self.version:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self.entries[key] = (monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: str):
+        self.version += 1
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self.entries.clear()
+
+    @property
+    def hit_ratio(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+INVALIDATION_CHANNEL = '__redis__:invalidate'
+
+class Invalidations:
+    def __init__(self, redis: Redis, caches: List[NearCache], prefix: str = '', retry_after: float = 1):
+        self.redis = redis
+        self.caches = caches
+        self.prefix = prefix
+        self.retry_after = retry_after
+        self.task: Optional[Task] = None
+
+    async def start(self):
+        for cache in self.caches:
+            cache.active = False
+        self.task = create_task(self.listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except CancelledError:
+                pass
+            self.task = None
+        self.deactivate()
+
+    def invalidate(self, keys: Optional[List[bytes]]):
+        for cache in self.caches:
+            if keys is None:
+                cache.clear()
+            else:
+                for key in keys:
+                    cache.pop(key.decode()[len(self.prefix):])
+
+    def deactivate(self):
+        for cache in self.caches:
+            cache.active = False
+            cache.clear()
+
+    async def listen(self):
+        while True:
+            try:
+                await self.subscribe()
+            except (RedisError, OSError):
+                self.deactivate()
+                await sleep(self.retry_after)
+
+    async def subscribe(self):
+        connection = await self.redis.connection_pool.get_connection('SUBSCRIBE')
+        try:
+            # Broadcast tracking on a dedicated connection redirected to itself,
+            # so writes to any key with the prefix from any client are reported.
+            await connection.send_command('CLIENT', 'ID')
+            id = await connection.read_response()
+            tracking = ('CLIENT', 'TRACKING', 'ON', 'REDIRECT', id, 'BCAST')
+            await connection.send_command(*tracking, *(('PREFIX', self.prefix) if self.prefix else ()))
+            await connection.read_response()
+            await connection.send_command('SUBSCRIBE', INVALIDATION_CHANNEL)
+            await connection.read_response()
+            for cache in self.caches:
+                cache.clear()
+                cache.active = True
+            while True:
+                message = await connection.read_response()
+                if message[0] == b'message':
+                    self.invalidate(message[2])
+        finally:
+            await connection.disconnect()
+            await self.redis.connection_pool.release(connection)
@@ -0,0 +1,44 @@
+from copy import copy
+from functools import partial, wraps
+from asyncio import Task, create_task, wait
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from auth.metrics import COALESCED_CALLS
+
+# Concurrent reads of the same key within a worker share one backend call. The
+# first caller runs it and the rest wait on its task, then get a shallow copy of
+# its result, so callers never share a mutable model. If the first caller is
+# cancelled its call is cancelled with it and the callers still waiting start
+# over. A caller giving up while waiting does not affect the others. Functions
+# coalesced this way must not use a caller's database session or transaction.
+
+class Coalescer:
+    def __init__(self, operation: str):
+        self.calls: Dict[Hashable, Task] = {}
+        self.coalesced = COALESCED_CALLS.labels(operation)
+
+    def done(self, key: Hashable, task: Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            task = self.calls.get(key)
+            if task is None or task.done():
+                task = self.calls[key] = create_task(function())
+                task.add_done_callback(partial(self.done, key))
+                return await task
+            await wait((task,))
+            if not task.cancelled():
+                self.coalesced.value += 1
+                return copy(task.result())
+
+def coalesced(operation: str, key: Callable[..., Hashable]):
+    coalescer = Coalescer(operation)
+
+    def decorator(function):
+        @wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            return await coalescer.run(key(self, *args, **kwargs), partial(function, self, *args, **kwargs))
+        return wrapper
+    return decorator
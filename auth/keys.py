@@ -0,0 +1,197 @@
+import asyncio
+from time import time
+from bisect import bisect
+from hashlib import blake2b
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Sequence, Tuple, Type, Union
+
+from aioredis import Redis, from_url
+from aioredis.exceptions import RedisError, ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from auth.models import VerificationToken, unix_to_datetime
+
+try:
+    from redis.asyncio.cluster import RedisCluster
+    from redis import exceptions as cluster_exceptions
+except ImportError:
+    RedisCluster = None
+
+# The cluster client comes from redis-py, whose exceptions are not the aioredis
+# ones, so code that may talk to the session store catches these instead.
+# REDIS_UNAVAILABLE are the errors meaning the store could not be reached.
+if RedisCluster is None:
+    REDIS_ERRORS: Tuple[Type[Exception], ...] = (RedisError,)
+    REDIS_UNAVAILABLE: Tuple[Type[Exception], ...] = (RedisConnectionError, RedisTimeoutError)
+else:
+    REDIS_ERRORS = (RedisError, cluster_exceptions.RedisError, cluster_exceptions.RedisClusterException)
+    REDIS_UNAVAILABLE = (
+        RedisConnectionError, RedisTimeoutError,
+        cluster_exceptions.ConnectionError, cluster_exceptions.TimeoutError,
+        cluster_exceptions.ClusterDownError, cluster_exceptions.RedisClusterException
+    )
+
+# Every key the adapters write lives under one prefix, with a namespace per kind
+# of record. The part of a key between braces is its hash tag: Redis Cluster and
+# the ring below place keys with the same tag on the same node, so keys that are
+# written together by a script or a transaction must share a tag.
+
+def tag(value: Any) -> str:
+    return '{' + str(value) + '}'
+
+def hash_tag(key: str) -> str:
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+class Keys:
+    def __init__(self, prefix: str = 'auth'):
+        self.prefix = prefix
+
+    def session(self, token: str) -> str:
+        return f'{self.prefix}:session:{token}'
+
+    def user_sessions(self, user_id: int) -> str:
+        return f'{self.prefix}:user:{user_id}:sessions'
+
+    # An identifier's verification tokens and their index share its tag, so they
+    # can be written and consumed together by one script.
+    def verification_token(self, identifier: str, token: str) -> str:
+        return f'{self.prefix}:verification:{tag(identifier)}:{token}'
+
+    def verification_tokens(self, identifier: str) -> str:
+        return f'{self.prefix}:identifier:{tag(identifier)}:verification'
+
+    def caller_wrote(self, caller: str) -> str:
+        return f'{self.prefix}:caller:{caller}:wrote'
+
+KEYS = Keys()
+
+
+def point(value: str) -> int:
+    return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+class RingScript:
+    def __init__(self, ring: 'Ring', script: str):
+        self.ring = ring
+        self.scripts = {name: node.register_script(script) for name, node in ring.nodes.items()}
+
+    async def __call__(self, keys: Sequence[str], args: Sequence[Any] = ()):
+        return await self.scripts[self.ring.name(keys[0])](keys=keys, args=args)
+
+class Ring:
+    # Consistent hashing over standalone nodes. Each node owns many points on the
+    # ring, named after the node, so adding or removing one only moves the keys
+    # it owns and the order nodes are given in does not matter.
+    def __init__(self, nodes: Dict[str, Redis], points: int = 160):
+        self.nodes = nodes
+        ring = sorted((point(f'{name}#{index}'), name) for name in nodes for index in range(points))
+        self.points = [position for position, _ in ring]
+        self.names = [name for _, name in ring]
+
+    def name(self, key: str) -> str:
+        return self.names[bisect(self.points, point(hash_tag(key))) % len(self.points)]
+
+    def node(self, key: str) -> Redis:
+        return self.nodes[self.name(key)]
+
+    def register_script(self, script: str) -> RingScript:
+        return RingScript(self, script)
+
+    async def close(self):
+        for node in self.nodes.values():
+            await node.close()
+            await node.connection_pool.disconnect()
+
+Store = Union[Redis, Ring, 'RedisCluster']
+
+def route(redis: Store, key: str) -> Redis:
+    # Commands on a single key, and pipelines over keys sharing a tag, are sent to
+    # the client this returns. A cluster client routes them by itself.
+    return redis.node(key) if isinstance(redis, Ring) else redis
+
+def partition(redis: Store, keys: Sequence[str]) -> List[List[str]]:
+    # Groups keys that one script call may touch together: all of them on a single
+    # Redis, those on the same node of a ring, or those in the same cluster slot.
+    if isinstance(redis, Redis):
+        return [list(keys)] if keys else []
+    owner = redis.name if isinstance(redis, Ring) else redis.keyslot
+    groups: Dict[Any, List[str]] = {}
+    for key in keys:
+        groups.setdefault(owner(key), []).append(key)
+    return list(groups.values())
+
+def connect(urls: List[str], cluster: bool = False) -> Store:
+    if cluster:
+        if RedisCluster is None:
+            raise RuntimeError("Redis Cluster support requires the redis package")
+        return RedisCluster.from_url(urls[0])
+    if len(urls) == 1:
+        return from_url(urls[0])
+    return Ring({url: from_url(url) for url in urls})
+
+
+# Deployments from before the key layout kept sessions and verification tokens
+# as bare tokens. Sessions are hashes, or strings holding a numeric user id, and
+# verification tokens are strings holding an identifier. Sessions are copied with
+# their remaining time to live and removed from the source. Verification tokens,
+# bare or under the untagged auth:verification:<token> keys, are added again
+# under their identifier with the same expiry.
+
+async def migrate(source: Redis, target: Store, keys: Keys = KEYS, batch: int = 1000) -> Dict[str, int]:
+    from auth.adapters import VerificationTokens  # the adapters import this module
+    tokens = VerificationTokens(target, keys)
+    untagged = f'{keys.prefix}:verification:'.encode()
+    moved = {'sessions': 0, 'verification_tokens': 0}
+    cursor = 0
+    while True:
+        cursor, names = await source.scan(cursor, count=batch)
+        for name in names:
+            bare = b':' not in name
+            if not bare and not (name.startswith(untagged) and b'{' not in name):
+                continue
+            kind = await source.type(name)
+            if kind == b'string':
+                value = await source.get(name)
+                if value is None:
+                    continue
+                if not bare or not value.isdigit():
+                    ttl = await source.ttl(name)
+                    if ttl > 0:
+                        await tokens.add(VerificationToken(
+                            token=(name if bare else name[len(untagged):]).decode(),
+                            identifier=value.decode(),
+                            expires_at=unix_to_datetime(int(time()) + ttl)
+                        ))
+                    await source.delete(name)
+                    moved['verification_tokens'] += 1
+                    continue
+            elif kind != b'hash' or not bare:
+                continue
+            new = keys.session(name.decode())
+            ttl, dump = await source.pttl(name), await source.dump(name)
+            if dump is None or ttl == -2:
+                continue
+            await route(target, new).restore(new, max(ttl, 0), dump, replace=True)
+            await source.delete(name)
+            moved['sessions'] += 1
+        if cursor == 0:
+            return moved
+
+async def main(arguments):
+    source = from_url(arguments.url)
+    target = connect(arguments.to.split(',') if arguments.to else [arguments.url], arguments.cluster)
+    print(await migrate(source, target, Keys(arguments.prefix)))
+    await source.close()
+    await target.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m auth.keys', description='Move sessions and verification tokens stored under earlier layouts to the key layout')
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('--url', default='redis://localhost:6379/0', help='Redis holding keys in the old layout')
+    parser.add_argument('--to', default=None, help='Comma separated Redis URLs to move the keys to, defaults to --url')
+    parser.add_argument('--cluster', action='store_true', help='The target is a Redis Cluster')
+    parser.add_argument('--prefix', default=KEYS.prefix)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,300 @@
+import heapq
+from time import time
+from itertools import count
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Hashable, List, Optional, Set, Tuple
+
+from auth.models import User, UserExport, Account, Session, VerificationToken, Credential, SessionAndUser
+from auth.models import datetime_to_unix, unix_to_datetime, trusted
+from auth.passwords import PasswordHasher, PASSWORD_HASHER
+from auth.ports import Conflict
+
+# Storage kept in the process, for single node deployments and for running the
+# tests and benchmarks without Postgres or Redis. Writes are applied as they are
+# made, so commit has nothing left to do and there is no rollback. Records are
+# copied in and out so callers never share them with the store.
+
+class Expiring:
+    # Entries with a deadline, dropped by draining a heap of deadlines on access.
+    # Moving a deadline leaves the old heap entry behind, which is skipped when it
+    # comes up, and the heap is rebuilt once stale entries outnumber live ones.
+    def __init__(self):
+        self.entries: Dict[Hashable, Tuple[int, Any]] = {}
+        self.deadlines: List[Tuple[int, Hashable]] = []
+
+    def expire(self):
+        now = time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == deadline:
+                del self.entries[key]
+
+    def get(self, key: Hashable) -> Optional[Tuple[int, Any]]:
+        self.expire()
+        return self.entries.get(key)
+
+    def set(self, key: Hashable, deadline: int, value: Any):
+        self.expire()
+        if deadline <= time():
+            self.entries.pop(key, None)
+            return
+        self.entries[key] = (deadline, value)
+        heapq.heappush(self.deadlines, (deadline, key))
+        if len(self.deadlines) > 2 * len(self.entries) + 64:
+            self.deadlines = [(deadline, key) for key, (deadline, _) in self.entries.items()]
+            heapq.heapify(self.deadlines)
+
+    def pop(self, key: Hashable) -> Optional[Tuple[int, Any]]:
+        return self.entries.pop(key, None)
+
+
+class MemoryUsers:
+    def __init__(self, storage: 'MemoryStorage'):
+        self.storage = storage
+
+    def insert(self, user: User) -> User:
+        id = next(self.storage.ids)
+        stored = user.model_copy(update={'id': id})
+        self.storage.users[id] = stored
+        self.storage.emails[stored.email] = id
+        self.storage.user_accounts[id] = set()
+        self.storage.user_credentials[id] = set()
+        return stored
+
+    def find(self, id: Optional[int]) -> Optional[User]:
+        user = self.storage.users.get(id)
+        return user.model_copy() if user is not None else None
+
+    async def create(self, user: User) -> User:
+        if user.email in self.storage.emails:
+            raise Conflict("User already exists")
+        return self.insert(user).model_copy()
+
+    async def create_with_account(self, user: User, account: Account) -> User:
+        if user.email in self.storage.emails or (account.provider, account.id) in self.storage.accounts:
+            raise Conflict("User or account already exists")
+        stored = self.insert(user)
+        self.storage.link(account.model_copy(update={'user_id': stored.id}))
+        return stored.model_copy()
+
+    async def get(self, id: int) -> Optional[User]:
+        return self.find(id)
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        return self.find(self.storage.emails.get(email))
+
+    async def get_by_account(self, provider: str, id: str) -> Optional[User]:
+        account = self.storage.accounts.get((provider, id))
+        return self.find(account.user_id) if account is not None else None
+
+    async def get_many(self, ids: List[int]) -> List[Optional[User]]:
+        return [self.find(id) for id in ids]
+
+    async def get_many_by_email(self, emails: List[str]) -> List[Optional[User]]:
+        return [await self.get_by_email(email) for email in emails]
+
+    async def get_many_by_account(self, pairs: List[Tuple[str, str]]) -> List[Optional[User]]:
+        return [await self.get_by_account(provider, id) for provider, id in pairs]
+
+    async def export(self, after: int = 0, batch_size: int = 1000) -> AsyncIterator[UserExport]:
+        # Ids are handed out in increasing order, so the users dict is already sorted.
+        for id in [id for id in self.storage.users if id > after]:
+            user = self.storage.users.get(id)
+            if user is not None:
+                accounts = [self.storage.accounts[key].model_copy() for key in self.storage.user_accounts[id]]
+                accounts.sort(key=lambda account: (account.provider, account.id))
+                yield trusted(UserExport, {**user.__dict__, 'accounts': accounts})
+
+    async def update(self, user: User) -> User:
+        current = self.storage.users[user.id]
+        if user.email != current.email:
+            if user.email in self.storage.emails:
+                raise Conflict("Email already in use")
+            del self.storage.emails[current.email]
+            self.storage.emails[user.email] = user.id
+        self.storage.users[user.id] = user.model_copy()
+        return user.model_copy()
+
+    async def delete(self, id: int):
+        user = self.storage.users.pop(id, None)
+        if user is None:
+            return
+        del self.storage.emails[user.email]
+        for key in self.storage.user_accounts.pop(id):
+            del self.storage.accounts[key]
+        for username in self.storage.user_credentials.pop(id):
+            del self.storage.credentials[username]
+
+class MemoryAccounts:
+    def __init__(self, storage: 'MemoryStorage'):
+        self.storage = storage
+
+    async def add(self, account: Account) -> Account:
+        if account.user_id not in self.storage.users:
+            raise Conflict("User does not exist")
+        if (account.provider, account.id) in self.storage.accounts:
+            raise Conflict("Account already exists")
+        self.storage.link(account.model_copy())
+        return account
+
+    async def remove(self, provider: str, id: str):
+        account = self.storage.accounts.pop((provider, id), None)
+        if account is not None:
+            self.storage.user_accounts[account.user_id].discard((provider, id))
+
+class MemoryCredentials:
+    def __init__(self, storage: 'MemoryStorage'):
+        self.storage = storage
+
+    async def add(self, credential: Credential):
+        if credential.user_id not in self.storage.users:
+            raise Conflict("User does not exist")
+        if credential.username in self.storage.credentials:
+            raise Conflict("Username already exists")
+        password = await self.storage.hasher.hash(credential.password.get_secret_value())
+        self.storage.credentials[credential.username] = (credential.user_id, password)
+        self.storage.user_credentials[credential.user_id].add(credential.username)
+
+    async def verify(self, credential: Credential) -> bool:
+        stored = self.storage.credentials.get(credential.username)
+        return await self.storage.hasher.verify(credential.password.get_secret_value(), stored[1]) if stored is not None else False
+
+    async def remove(self, credential: Credential):
+        stored = self.storage.credentials.pop(credential.username, None)
+        if stored is not None:
+            self.storage.user_credentials[stored[0]].discard(credential.username)
+
+
+class MemorySessions:
+    # Expiries are kept in whole seconds, as Redis keeps them.
+    def __init__(self):
+        self.sessions = Expiring()
+        self.users: Dict[int, Set[str]] = {}
+
+    def session(self, token: str, entry: Tuple[int, Any]) -> Session:
+        return trusted(Session, {'token': token, 'user_id': entry[1], 'expires_at': unix_to_datetime(entry[0])})
+
+    async def add(self, session: Session) -> Session:
+        await self.delete(session.token)
+        self.sessions.set(session.token, datetime_to_unix(session.expires_at), session.user_id)
+        self.users.setdefault(session.user_id, set()).add(session.token)
+        return session
+
+    async def get(self, token: str) -> Optional[Session]:
+        entry = self.sessions.get(token)
+        return self.session(token, entry) if entry is not None else None
+
+    async def get_by_user(self, user_id: int) -> List[Session]:
+        tokens = self.users.get(user_id, set())
+        found = [(token, self.sessions.get(token)) for token in tokens]
+        tokens.difference_update(token for token, entry in found if entry is None)
+        sessions = [self.session(token, entry) for token, entry in found if entry is not None]
+        return sorted(sessions, key=lambda session: (session.expires_at, session.token))
+
+    async def update(self, session: Session) -> Session:
+        entry = self.sessions.get(session.token)
+        if entry is not None:
+            self.sessions.set(session.token, datetime_to_unix(session.expires_at), entry[1])
+        return session
+
+    async def delete(self, token: str):
+        entry = self.sessions.pop(token)
+        if entry is not None:
+            self.users.get(entry[1], set()).discard(token)
+
+    async def delete_by_user(self, user_id: int) -> int:
+        tokens = self.users.pop(user_id, set())
+        for token in tokens:
+            self.sessions.pop(token)
+        return len(tokens)
+
+class MemoryVerificationTokens:
+    def __init__(self):
+        self.tokens = Expiring()
+        self.identifiers: Dict[str, Set[str]] = {}
+
+    def verification_token(self, identifier: str, token: str, entry: Tuple[int, Any]) -> VerificationToken:
+        return trusted(VerificationToken, {'token': token, 'identifier': identifier, 'expires_at': unix_to_datetime(entry[0])})
+
+    async def add(self, verification_token: VerificationToken) -> VerificationToken:
+        identifier = verification_token.identifier
+        tokens = self.identifiers.setdefault(identifier, set())
+        tokens.difference_update([token for token in tokens if self.tokens.get((identifier, token)) is None])
+        expires_at = datetime_to_unix(verification_token.expires_at)
+        self.tokens.set((identifier, verification_token.token), expires_at, None)
+        if expires_at > time():
+            tokens.add(verification_token.token)
+        return verification_token
+
+    async def get(self, identifier: str, token: str) -> Optional[VerificationToken]:
+        entry = self.tokens.get((identifier, token))
+        return self.verification_token(identifier, token, entry) if entry is not None else None
+
+    async def use(self, identifier: str, token: str) -> Optional[VerificationToken]:
+        entry = self.tokens.get((identifier, token))
+        if entry is None:
+            return None
+        self.tokens.pop((identifier, token))
+        self.identifiers.get(identifier, set()).discard(token)
+        return self.verification_token(identifier, token, entry)
+
+    async def update(self, verification_token: VerificationToken):
+        await self.add(verification_token)
+
+    async def delete(self, identifier: str, token: str):
+        await self.use(identifier, token)
+
+    async def invalidate(self, identifier: str) -> int:
+        tokens = self.identifiers.pop(identifier, set())
+        return sum(self.tokens.pop((identifier, token)) is not None for token in tokens)
+
+
+class MemorySessionsAndUsers:
+    def __init__(self, storage: 'MemoryStorage'):
+        self.storage = storage
+
+    async def get(self, token: str) -> Optional[SessionAndUser]:
+        session = await self.storage.sessions.get(token)
+        if session is None:
+            return None
+        user = self.storage.users.get(session.user_id)
+        if user is None:
+            return None
+        return trusted(SessionAndUser, {'session': session, 'user': user.model_copy()})
+
+class MemoryTransaction:
+    def __init__(self, storage: 'MemoryStorage'):
+        self.users = MemoryUsers(storage)
+        self.accounts = MemoryAccounts(storage)
+        self.credentials = MemoryCredentials(storage)
+        self.sessions_and_users = MemorySessionsAndUsers(storage)
+
+    async def commit(self):
+        pass
+
+class MemoryStorage:
+    def __init__(self, hasher: PasswordHasher = PASSWORD_HASHER):
+        self.hasher = hasher
+        self.ids = count(1)
+        self.users: Dict[int, User] = {}
+        self.emails: Dict[str, int] = {}
+        self.accounts: Dict[Tuple[str, str], Account] = {}
+        self.user_accounts: Dict[int, Set[Tuple[str, str]]] = {}
+        self.credentials: Dict[str, Tuple[int, str]] = {}
+        self.user_credentials: Dict[int, Set[str]] = {}
+        self.sessions = MemorySessions()
+        self.verification_tokens = MemoryVerificationTokens()
+        self.transaction = MemoryTransaction(self)
+
+    def link(self, account: Account):
+        self.accounts[(account.provider, account.id)] = account
+        self.user_accounts[account.user_id].add((account.provider, account.id))
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[MemoryTransaction]:
+        yield self.transaction
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[MemoryTransaction]:
+        yield self.transaction
@@ -0,0 +1,174 @@
+from time import perf_counter
+from bisect import bisect_left
+from functools import wraps
+from typing import Any, Callable, Dict, List, Tuple
+
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Metrics are plain counters mutated from the event loop thread, so there are no
+# locks on the hot path. Each worker process exposes its own values.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        return [f'{name}{labels} {self.value}']
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        lines = []
+        total = 0
+        prefix = labels[:-1] + ',' if labels else '{'
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{prefix}le="{bound}"}} {total}')
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {total}')
+        return lines
+
+
+class Family:
+    def __init__(self, name: str, help: str, type: str, factory: Callable[[], Any], labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.factory = factory
+        self.label_names = labels
+        self.children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for values, child in list(self.children.items()):
+            lines.extend(child.samples(self.name, format_labels(self.label_names, values)))
+        return lines
+
+class Collected:
+    def __init__(self, name: str, help: str, function: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {float(self.function())}']
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Family:
+        return self.metrics.setdefault(name, Family(name, help, 'counter', Counter, labels))
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Family:
+        return self.metrics.setdefault(name, Family(name, help, 'gauge', Gauge, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Family:
+        return self.metrics.setdefault(name, Family(name, help, 'histogram', Histogram, labels))
+
+    def collect(self, name: str, help: str, function: Callable[[], float]):
+        self.metrics[name] = Collected(name, help, function)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+ADAPTER_LATENCY = REGISTRY.histogram('auth_adapter_latency_seconds', 'Latency of adapter calls.', ('operation',))
+ADAPTER_ERRORS = REGISTRY.counter('auth_adapter_errors_total', 'Adapter calls that raised.', ('operation',))
+ADAPTER_IN_FLIGHT = REGISTRY.gauge('auth_adapter_in_flight', 'Adapter calls in progress.', ('operation',))
+
+COALESCED_CALLS = REGISTRY.counter('auth_adapter_coalesced_total', 'Adapter reads served by an identical call already in flight.', ('operation',))
+
+ADMISSION_REJECTED = REGISTRY.counter('auth_admission_rejected_total', 'Requests turned away with a 503.', ('route_class', 'reason'))
+
+ROUTE_LATENCY = REGISTRY.histogram('auth_http_request_duration_seconds', 'Latency of HTTP requests.', ('method', 'route'))
+ROUTE_ERRORS = REGISTRY.counter('auth_http_request_errors_total', 'HTTP requests that failed with a server error.', ('method', 'route'))
+ROUTE_IN_FLIGHT = REGISTRY.gauge('auth_http_requests_in_flight', 'HTTP requests in progress.', ('method', 'route'))
+
+def instrumented(operation: str):
+    latency = ADAPTER_LATENCY.labels(operation)
+    errors = ADAPTER_ERRORS.labels(operation)
+    in_flight = ADAPTER_IN_FLIGHT.labels(operation)
+
+    def decorator(function):
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            in_flight.value += 1
+            start = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                errors.value += 1
+                raise
+            finally:
+                in_flight.value -= 1
+                latency.observe(perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRoute(APIRoute):
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        method = ','.join(sorted(self.methods))
+        latency = ROUTE_LATENCY.labels(method, self.path)
+        errors = ROUTE_ERRORS.labels(method, self.path)
+        in_flight = ROUTE_IN_FLIGHT.labels(method, self.path)
+
+        async def instrumented_handler(request: Request) -> Response:
+            in_flight.value += 1
+            start = perf_counter()
+            try:
+                response = await handler(request)
+                if response.status_code >= 500:
+                    errors.value += 1
+                return response
+            except HTTPException as exception:
+                if exception.status_code >= 500:
+                    errors.value += 1
+                raise
+            except Exception:
+                errors.value += 1
+                raise
+            finally:
+                in_flight.value -= 1
+                latency.observe(perf_counter() - start)
+        return instrumented_handler
@@ -1,6 +1,7 @@
 from typing import Optional
 from typing import Union
 from typing import List
+from typing import Any, Dict, Type, TypeVar
 from datetime import datetime
 from datetime import timezone
 from pydantic import BaseModel
@@ -20,6 +21,18 @@ class Model(BaseModel):
         populate_by_name=True,
     )
 
+M = TypeVar('M', bound=BaseModel)
+
+def trusted(model: Type[M], values: Dict[str, Any]) -> M:
+    # Builds a model from values that already have the field types, such as rows
+    # read back from storage, without running validation. Every field must be given.
+    instance = model.__new__(model)
+    object.__setattr__(instance, '__dict__', values)
+    object.__setattr__(instance, '__pydantic_fields_set__', set(values))
+    object.__setattr__(instance, '__pydantic_extra__', None)
+    object.__setattr__(instance, '__pydantic_private__', None)
+    return instance
+
 class Session(Model):
     token: str = Field(..., alias="sessionToken")
     user_id: Optional[int] = Field(None, alias="userId")
@@ -70,4 +83,19 @@ class VerificationToken(Model):
 
     @field_serializer("expires_at")
     def iso_format(expires_at: datetime) -> str:
-        return expires_at.isoformat()
\ No newline at end of file
+        return expires_at.isoformat()
+
+class SessionAndUser(Model):
+    session: Session = Field(...)
+    user: User = Field(...)
+
+class UserExport(User):
+    accounts: List[Account] = Field(default_factory=list)
+
+class SignUpAccount(Account):
+    user_id: Optional[int] = Field(default=None, alias="userId")
+
+class SignUp(Model):
+    user: User = Field(...)
+    account: SignUpAccount = Field(...)
+    session: Optional[Session] = Field(default=None)
@@ -0,0 +1,69 @@
+from asyncio import Future, Semaphore, TimeoutError, get_running_loop, shield, wait_for
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from passlib.context import CryptContext
+
+CRYPTOGRAPHY_CONTEXT = CryptContext(schemes=['bcrypt'], deprecated='auto')
+
+# Module level functions so they can be pickled into a process pool.
+
+def hash_password(password: str) -> str:
+    return CRYPTOGRAPHY_CONTEXT.hash(password)
+
+def verify_password(password: str, hash: str) -> bool:
+    return CRYPTOGRAPHY_CONTEXT.verify(password, hash)
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = 4, processes: bool = False, timeout: Optional[float] = 10):
+        self.executor: Executor = ProcessPoolExecutor(max_workers=workers) if processes else ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+        self.semaphore = Semaphore(workers)
+        self.timeout = timeout
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.timeouts = 0
+
+    async def run(self, function: Callable[..., Any], *args: Any) -> Any:
+        try:
+            return await wait_for(self.submit(function, *args), self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def submit(self, function: Callable[..., Any], *args: Any) -> Any:
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            future = get_running_loop().run_in_executor(self.executor, function, *args)
+        except BaseException:
+            self.finished(None)
+            raise
+        # A job keeps its worker after its caller times out, so its slot is only
+        # freed once it finishes, and the caller stops waiting without cancelling it.
+        future.add_done_callback(self.finished)
+        return await shield(future)
+
+    def finished(self, future: Optional[Future]):
+        if future is not None and not future.cancelled():
+            future.exception()
+        self.running -= 1
+        self.completed += 1
+        self.semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def verify(self, password: str, hash: str) -> bool:
+        return await self.run(verify_password, password, hash)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+PASSWORD_HASHER = PasswordHasher()
@@ -0,0 +1,67 @@
+from typing import AsyncContextManager, AsyncIterator, List, Optional, Protocol, Tuple
+
+from auth.models import User, UserExport, Account, Session, VerificationToken, Credential, SessionAndUser
+
+# The router only talks to storage through these protocols. Storage hands out
+# transactions for the records kept in the database, while sessions and
+# verification tokens live outside of them. The SQLAlchemy and Redis adapters
+# and the in-memory backend both implement them.
+
+class Conflict(Exception):
+    pass
+
+class Users(Protocol):
+    async def create(self, user: User) -> User: ...
+    async def create_with_account(self, user: User, account: Account) -> User: ...
+    async def get(self, id: int) -> Optional[User]: ...
+    async def get_by_email(self, email: str) -> Optional[User]: ...
+    async def get_by_account(self, provider: str, id: str) -> Optional[User]: ...
+    async def get_many(self, ids: List[int]) -> List[Optional[User]]: ...
+    async def get_many_by_email(self, emails: List[str]) -> List[Optional[User]]: ...
+    async def get_many_by_account(self, pairs: List[Tuple[str, str]]) -> List[Optional[User]]: ...
+    def export(self, after: int = 0, batch_size: int = 1000) -> AsyncIterator[UserExport]: ...
+    async def update(self, user: User) -> User: ...
+    async def delete(self, id: int): ...
+
+class Accounts(Protocol):
+    async def add(self, account: Account) -> Account: ...
+    async def remove(self, provider: str, id: str): ...
+
+class Credentials(Protocol):
+    async def add(self, credential: Credential): ...
+    async def verify(self, credential: Credential) -> bool: ...
+    async def remove(self, credential: Credential): ...
+
+class Sessions(Protocol):
+    async def add(self, session: Session) -> Session: ...
+    async def get(self, token: str) -> Optional[Session]: ...
+    async def get_by_user(self, user_id: int) -> List[Session]: ...
+    async def update(self, session: Session) -> Session: ...
+    async def delete(self, token: str): ...
+    async def delete_by_user(self, user_id: int) -> int: ...
+
+class SessionsAndUsers(Protocol):
+    async def get(self, token: str) -> Optional[SessionAndUser]: ...
+
+class VerificationTokens(Protocol):
+    async def add(self, verification_token: VerificationToken) -> VerificationToken: ...
+    async def get(self, identifier: str, token: str) -> Optional[VerificationToken]: ...
+    async def use(self, identifier: str, token: str) -> Optional[VerificationToken]: ...
+    async def update(self, verification_token: VerificationToken): ...
+    async def delete(self, identifier: str, token: str): ...
+    async def invalidate(self, identifier: str) -> int: ...
+
+class Transaction(Protocol):
+    users: Users
+    accounts: Accounts
+    credentials: Credentials
+    sessions_and_users: SessionsAndUsers
+
+    async def commit(self): ...
+
+class Storage(Protocol):
+    sessions: Sessions
+    verification_tokens: VerificationTokens
+
+    def read(self) -> AsyncContextManager[Transaction]: ...
+    def write(self) -> AsyncContextManager[Transaction]: ...
@@ -0,0 +1,85 @@
+from time import monotonic
+from itertools import count
+from functools import partial
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from auth.keys import KEYS, REDIS_ERRORS, Keys, Store, route
+
+ROUND_ROBIN = 'round_robin'
+LEAST_BUSY = 'least_busy'
+
+class Replicas:
+    # Read only routes take their sessions from here. A caller that wrote within
+    # the last sticky_for seconds reads from the primary instead, so it sees its
+    # own writes while they replicate. With a store the marker is also kept in
+    # Redis, so it holds across workers; without one it only holds in this process.
+    def __init__(self, primary: async_sessionmaker[AsyncSession], replicas: List[async_sessionmaker[AsyncSession]], strategy: str = ROUND_ROBIN, sticky_for: float = 0, max_callers: int = 10000, store: Optional[Store] = None, keys: Keys = KEYS):
+        if strategy not in (ROUND_ROBIN, LEAST_BUSY):
+            raise ValueError(f"Unknown replica strategy {strategy}")
+        self.primary = primary
+        self.replicas = replicas
+        self.strategy = strategy
+        self.sticky_for = sticky_for
+        self.max_callers = max_callers
+        self.in_flight = [0] * len(replicas)
+        self.counter = count()
+        self.writes: OrderedDict[str, float] = OrderedDict()
+        self.store = store
+        self.keys = keys
+
+    # Callers without an id are never pinned, every request would share one marker.
+    async def wrote(self, caller: str):
+        if self.sticky_for <= 0 or not caller:
+            return
+        self.writes[caller] = monotonic() + self.sticky_for
+        self.writes.move_to_end(caller)
+        while len(self.writes) > self.max_callers:
+            self.writes.popitem(last=False)
+        if self.store is not None:
+            key = self.keys.caller_wrote(caller)
+            try:
+                await route(self.store, key).set(key, 1, px=max(int(self.sticky_for * 1000), 1))
+            except REDIS_ERRORS:
+                pass
+
+    def sticky(self, caller: str) -> bool:
+        deadline = self.writes.get(caller)
+        if deadline is None:
+            return False
+        if deadline <= monotonic():
+            del self.writes[caller]
+            return False
+        return True
+
+    async def shared_sticky(self, caller: str) -> bool:
+        if self.store is None or self.sticky_for <= 0 or not caller:
+            return False
+        key = self.keys.caller_wrote(caller)
+        try:
+            return bool(await route(self.store, key).exists(key))
+        except REDIS_ERRORS:
+            # Without the marker the caller may have written through another
+            # worker, so it reads from the primary.
+            return True
+
+    def choose(self) -> int:
+        if self.strategy == LEAST_BUSY:
+            return min(range(len(self.replicas)), key=self.in_flight.__getitem__)
+        return next(self.counter) % len(self.replicas)
+
+    @asynccontextmanager
+    async def read(self, index: int) -> AsyncIterator[AsyncSession]:
+        self.in_flight[index] += 1
+        try:
+            async with self.replicas[index]() as session:
+                yield session
+        finally:
+            self.in_flight[index] -= 1
+
+    async def reader(self, caller: str) -> Callable[[], AsyncSession]:
+        if not self.replicas or self.sticky(caller) or await self.shared_sticky(caller):
+            return self.primary
+        return partial(self.read, self.choose())
@@ -0,0 +1,22 @@
+from typing import Any
+
+from pydantic_core import to_json, to_jsonable_python
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = 'application/msgpack'
+
+# Routes return their models through render, which serializes them straight to
+# bytes with pydantic's serializer. Returning a Response also makes FastAPI skip
+# validating the result against the route's return annotation, which is kept for
+# the OpenAPI schema.
+
+def render(request: Request, content: Any, status_code: int = 200) -> Response:
+    if msgpack is not None and MSGPACK in request.headers.get('accept', ''):
+        return Response(msgpack.packb(to_jsonable_python(content, by_alias=True)), status_code=status_code, media_type=MSGPACK)
+    return Response(to_json(content, by_alias=True), status_code=status_code, media_type='application/json')
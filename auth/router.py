@@ -1,147 +1,298 @@
 from typing import AsyncGenerator
-from pydantic import BaseModel
+from typing import Optional
+from typing import List
+from asyncio import TimeoutError
+from contextlib import AsyncExitStack
+from pydantic import BaseModel, Field
 from fastapi import APIRouter, HTTPException
-from fastapi import Depends
+from fastapi import Depends, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from aioredis import Redis
 
-from auth.models import User, Account, Session, VerificationToken, Credential
-from auth.adapters import Users, Accounts, Sessions, VerificationTokens, Credentials
+from auth.models import User, Account, Session, VerificationToken, Credential, SessionAndUser, SignUp
+from auth.adapters import Storage, SlidingExpiry
+from auth import ports
+from auth.caches import UsersCache, NearCache
+from auth.keys import Keys, KEYS, Store
+from auth.replicas import Replicas
+from auth.passwords import PasswordHasher, PASSWORD_HASHER
+from auth.metrics import InstrumentedRoute, REGISTRY
+from auth.responses import render
+from auth.admission import EXPORTS, Admission, Overloaded, route_class
+from auth.exports import ndjson
 
 def get_session_maker() -> async_sessionmaker[AsyncSession]:
     raise NotImplementedError("You must provide a session maker")
 
-def get_redis() -> Redis:
+def get_replicas() -> Optional[Replicas]:
+    return None
+
+def get_caller(request: Request) -> str:
+    # Requests all come through the Next.js server, so its address says nothing
+    # about who is calling and only the header is used.
+    return request.headers.get('x-caller-id', '')
+
+def get_redis() -> Store:
     raise NotImplementedError("You must provide a Redis connection")
 
-router = APIRouter()
+def get_keys() -> Keys:
+    return KEYS
+
+def get_users_cache() -> Optional[UsersCache]:
+    return None
+
+def get_sessions_cache() -> Optional[NearCache]:
+    return None
+
+def get_password_hasher() -> PasswordHasher:
+    return PASSWORD_HASHER
+
+def get_sliding_expiry() -> Optional[SlidingExpiry]:
+    return None
+
+def get_admission() -> Optional[Admission]:
+    return None
+
+def unavailable(overloaded: Overloaded) -> HTTPException:
+    return HTTPException(status_code=503, detail=f"Service overloaded: {overloaded.reason}", headers={'Retry-After': str(overloaded.retry_after)})
+
+# Exports are admitted by their route instead: their body is streamed after the
+# dependencies have exited, and the admission must last until it is sent.
+async def admitted(request: Request, admission: Optional[Admission] = Depends(get_admission)) -> AsyncGenerator[None, None]:
+    kind = route_class(request.method, request.scope['route'].path) if admission is not None else None
+    if kind is None or kind == EXPORTS:
+        yield
+        return
+    try:
+        async with admission.admit(kind):
+            yield
+    except Overloaded as overloaded:
+        raise unavailable(overloaded)
+
+# Routes reach storage only through get_storage. By default it is Postgres and
+# Redis, built from the dependencies above. Overriding it with another backend,
+# such as auth.memory.MemoryStorage, replaces all of them.
+
+def get_storage(
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker),
+    redis: Store = Depends(get_redis),
+    keys: Keys = Depends(get_keys),
+    users_cache: Optional[UsersCache] = Depends(get_users_cache),
+    sessions_cache: Optional[NearCache] = Depends(get_sessions_cache),
+    hasher: PasswordHasher = Depends(get_password_hasher),
+    replicas: Optional[Replicas] = Depends(get_replicas),
+    caller: str = Depends(get_caller),
+    sliding: Optional[SlidingExpiry] = Depends(get_sliding_expiry)
+) -> ports.Storage:
+    return Storage(session_maker, redis, keys, users_cache, sessions_cache, hasher, replicas, caller, sliding)
+
+router = APIRouter(route_class=InstrumentedRoute, dependencies=[Depends(admitted)])
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
 
 @router.post('/users')
-async def create_user(user: User, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)) -> User:
-    async with session_maker() as session:
-        users = Users(session)
-        user = await users.create(user)
-        await session.commit()
-        return user
+async def create_user(request: Request, user: User, storage: ports.Storage = Depends(get_storage)) -> User:
+    async with storage.write() as transaction:
+        user = await transaction.users.create(user)
+        await transaction.commit()
+        return render(request, user)
     
 @router.patch('/users')
-async def update_user(user: User, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)) -> User:
-    async with session_maker() as session:
-        users = Users(session)
-        user = await users.update(user)
-        await session.commit()
-        return user
+async def update_user(request: Request, user: User, storage: ports.Storage = Depends(get_storage)) -> User:
+    async with storage.write() as transaction:
+        user = await transaction.users.update(user)
+        await transaction.commit()
+        return render(request, user)
     
 @router.delete('/users/{user_id}')
-async def delete_user(user_id: int, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)):
-    async with session_maker() as session:
-        users = Users(session)
-        await users.delete(user_id)
-        await session.commit()
+async def delete_user(user_id: int, storage: ports.Storage = Depends(get_storage)):
+    async with storage.write() as transaction:
+        await transaction.users.delete(user_id)
+        await transaction.commit()
+    await storage.sessions.delete_by_user(user_id)
+
+# Declared before /users/{user_id} so that export is not taken for an id.
+@router.get('/users/export', response_class=StreamingResponse)
+async def export_users(after: int = 0, tokens: bool = False, storage: ports.Storage = Depends(get_storage), admission: Optional[Admission] = Depends(get_admission)):
+    # Admitted before the response starts, so it can still be turned away with a
+    # 503, and released once the body is sent. The background task releases it
+    # when the client left before the body was started.
+    held = AsyncExitStack()
+    if admission is not None:
+        try:
+            await held.enter_async_context(admission.admit(EXPORTS))
+        except Overloaded as overloaded:
+            raise unavailable(overloaded)
+    async def lines():
+        async with held:
+            async with storage.read() as transaction:
+                async for chunk in ndjson(transaction.users.export(after), tokens=tokens):
+                    yield chunk
+    return StreamingResponse(lines(), media_type='application/x-ndjson', background=BackgroundTask(held.aclose))
 
 @router.get('/users/{user_id}')
-async def get_user(user_id: int, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)) -> User:
-    async with session_maker() as session:
-        users = Users(session)
-        user = await users.get(user_id)
+async def get_user(request: Request, user_id: int, storage: ports.Storage = Depends(get_storage)) -> User:
+    async with storage.read() as transaction:
+        user = await transaction.users.get(user_id)
         if user is None:
             raise HTTPException(status_code=404, detail="User not found")
-        return user
+        return render(request, user)
     
 @router.get('/users/emails/{email}')
-async def get_user_by_email(email: str, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)) -> User:
-    async with session_maker() as session:
-        users = Users(session)
-        user = await users.get_by_email(email)
+async def get_user_by_email(request: Request, email: str, storage: ports.Storage = Depends(get_storage)) -> User:
+    async with storage.read() as transaction:
+        user = await transaction.users.get_by_email(email)
         if user is None:
             raise HTTPException(status_code=404, detail="User not found")
-        return user
+        return render(request, user)
     
 @router.get('/users/accounts/{account_provider}/{account_id}') 
-async def get_user_by_account(account_provider: str, account_id: str, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)) -> User:
-    async with session_maker() as session:
-        users = Users(session)
-        user = await users.get_by_account(account_provider, account_id)
+async def get_user_by_account(request: Request, account_provider: str, account_id: str, storage: ports.Storage = Depends(get_storage)) -> User:
+    async with storage.read() as transaction:
+        user = await transaction.users.get_by_account(account_provider, account_id)
         if user is None:
             raise HTTPException(status_code=404, detail="User not found")
-        return user
+        return render(request, user)
+    
+BATCH_LIMIT = 1000
+
+class UsersBatch(BaseModel):
+    ids: List[int] = Field(..., max_length=BATCH_LIMIT)
+
+class EmailsBatch(BaseModel):
+    emails: List[str] = Field(..., max_length=BATCH_LIMIT)
+
+class AccountKey(BaseModel):
+    provider: str
+    id: str = Field(..., alias="providerAccountId")
+
+class AccountsBatch(BaseModel):
+    accounts: List[AccountKey] = Field(..., max_length=BATCH_LIMIT)
+
+@router.post('/users/batch')
+async def get_users(request: Request, batch: UsersBatch, storage: ports.Storage = Depends(get_storage)) -> List[Optional[User]]:
+    async with storage.read() as transaction:
+        return render(request, await transaction.users.get_many(batch.ids))
+
+@router.post('/users/emails/batch')
+async def get_users_by_email(request: Request, batch: EmailsBatch, storage: ports.Storage = Depends(get_storage)) -> List[Optional[User]]:
+    async with storage.read() as transaction:
+        return render(request, await transaction.users.get_many_by_email(batch.emails))
+
+@router.post('/users/accounts/batch')
+async def get_users_by_account(request: Request, batch: AccountsBatch, storage: ports.Storage = Depends(get_storage)) -> List[Optional[User]]:
+    async with storage.read() as transaction:
+        return render(request, await transaction.users.get_many_by_account([(account.provider, account.id) for account in batch.accounts]))
     
 @router.post('/users/accounts')
-async def link_account(account: Account, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)):
-    async with session_maker() as session:
-        accounts = Accounts(session)
-        account = await accounts.add(account)
-        await session.commit()
-        return account
+async def link_account(request: Request, account: Account, storage: ports.Storage = Depends(get_storage)):
+    async with storage.write() as transaction:
+        account = await transaction.accounts.add(account)
+        await transaction.commit()
+        return render(request, account)
+
+@router.post('/users/signup')
+async def sign_up(request: Request, sign_up: SignUp, storage: ports.Storage = Depends(get_storage)) -> SignUp:
+    async with storage.write() as transaction:
+        try:
+            user = await transaction.users.create_with_account(sign_up.user, sign_up.account)
+        except ports.Conflict:
+            raise HTTPException(status_code=409, detail="User or account already exists")
+        await transaction.commit()
+    sign_up.user = user
+    sign_up.account.user_id = user.id
+    if sign_up.session is not None:
+        sign_up.session.user_id = user.id
+        await storage.sessions.add(sign_up.session)
+    return render(request, sign_up)
 
 @router.delete('/users/accounts/{account_provider}/{account_id}')
-async def unlink_account(account_provider: str, account_id: str, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)):
-    async with session_maker() as session:
-        accounts = Accounts(session)
-        await accounts.remove(account_provider, account_id)
-        await session.commit()
+async def unlink_account(account_provider: str, account_id: str, storage: ports.Storage = Depends(get_storage)):
+    async with storage.write() as transaction:
+        await transaction.accounts.remove(account_provider, account_id)
+        await transaction.commit()
 
 @router.post('/users/sessions')
-async def create_session(session: Session, redis: Redis = Depends(get_redis)) -> Session:
-        sessions = Sessions(redis)
-        session = await sessions.add(session)
-        return session
+async def create_session(request: Request, session: Session, storage: ports.Storage = Depends(get_storage)) -> Session:
+        session = await storage.sessions.add(session)
+        return render(request, session)
     
 @router.patch('/users/sessions')
-async def update_session(session: Session, redis: Redis = Depends(get_redis)):
-    sessions = Sessions(redis)
-    await sessions.update(session)
+async def update_session(session: Session, storage: ports.Storage = Depends(get_storage)):
+    await storage.sessions.update(session)
     
 @router.delete('/users/sessions/{token}')
-async def delete_session(token: str, redis: Redis = Depends(get_redis)):
-    sessions = Sessions(redis)
-    await sessions.delete(token)
+async def delete_session(token: str, storage: ports.Storage = Depends(get_storage)):
+    await storage.sessions.delete(token)
     
 @router.get('/users/sessions/{token}')
-async def get_session(token: str, redis: Redis = Depends(get_redis)) -> Session:
-    sessions = Sessions(redis)
-    session = await sessions.get(token)
+async def get_session(request: Request, token: str, storage: ports.Storage = Depends(get_storage)) -> Session:
+    session = await storage.sessions.get(token)
     if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    return session
+    return render(request, session)
+
+@router.get('/users/sessions/{token}/user')
+async def get_session_and_user(request: Request, token: str, storage: ports.Storage = Depends(get_storage)) -> SessionAndUser:
+    async with storage.read() as transaction:
+        session_and_user = await transaction.sessions_and_users.get(token)
+        if session_and_user is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        return render(request, session_and_user)
     
+@router.get('/users/{user_id}/sessions')
+async def get_user_sessions(request: Request, user_id: int, storage: ports.Storage = Depends(get_storage)) -> List[Session]:
+    return render(request, await storage.sessions.get_by_user(user_id))
+
+@router.delete('/users/{user_id}/sessions')
+async def delete_user_sessions(user_id: int, storage: ports.Storage = Depends(get_storage)):
+    await storage.sessions.delete_by_user(user_id)
+
 @router.post('/users/verification')
-async def create_verification_token(token: VerificationToken, redis: Redis = Depends(get_redis)) -> VerificationToken:
-    tokens = VerificationTokens(redis)
-    token = await tokens.add(token)
-    return token
+async def create_verification_token(request: Request, token: VerificationToken, storage: ports.Storage = Depends(get_storage)) -> VerificationToken:
+    token = await storage.verification_tokens.add(token)
+    return render(request, token)
 
 class VerificationTokenUse(BaseModel):
+    identifier: str
     token: str
 
 @router.post('/users/verification/use')
-async def use_verification_token(token: VerificationTokenUse, redis: Redis = Depends(get_redis)) -> VerificationToken:
-    tokens = VerificationTokens(redis)
-    verification_token = await tokens.get(token.token)
+async def use_verification_token(request: Request, token: VerificationTokenUse, storage: ports.Storage = Depends(get_storage)) -> VerificationToken:
+    verification_token = await storage.verification_tokens.use(token.identifier, token.token)
     if verification_token is None:
         raise HTTPException(status_code=404, detail="Token not found")
-    await tokens.delete(token.token)
-    return verification_token
+    return render(request, verification_token)
+
+@router.delete('/users/verification/{identifier}')
+async def invalidate_verification_tokens(identifier: str, storage: ports.Storage = Depends(get_storage)):
+    await storage.verification_tokens.invalidate(identifier)
 
 @router.post('/users/credentials')
-async def add_credentials(credential: Credential, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)):
-    async with session_maker() as session:
-        credentials = Credentials(session)
-        await credentials.add(credential)
-        await session.commit()
+async def add_credentials(credential: Credential, storage: ports.Storage = Depends(get_storage)):
+    async with storage.write() as transaction:
+        try:
+            await transaction.credentials.add(credential)
+        except TimeoutError:
+            raise HTTPException(status_code=503, detail="Password hashing timed out")
+        await transaction.commit()
 
 @router.post('/users/credentials/verify')
-async def verify_credentials(credential: Credential, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)):
-    async with session_maker() as session:
-        credentials = Credentials(session)
-        verified = await credentials.verify(credential)
+async def verify_credentials(request: Request, credential: Credential, storage: ports.Storage = Depends(get_storage)):
+    async with storage.read() as transaction:
+        try:
+            verified = await transaction.credentials.verify(credential)
+        except TimeoutError:
+            raise HTTPException(status_code=503, detail="Password verification timed out")
         if not verified:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        return verified
+        return render(request, verified)
     
 @router.delete('/users/credentials')
-async def delete_credentials(credential: Credential, session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker)):
-    async with session_maker() as session:
-        credentials = Credentials(session)
-        await credentials.remove(credential)
-        await session.commit()
\ No newline at end of file
+async def delete_credentials(credential: Credential, storage: ports.Storage = Depends(get_storage)):
+    async with storage.write() as transaction:
+        await transaction.credentials.remove(credential)
+        await transaction.commit()
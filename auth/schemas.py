@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, BigInteger
-from sqlalchemy import Table, MetaData
+from sqlalchemy import Table, MetaData, Index
 
 metadata = MetaData()
 
@@ -11,6 +11,7 @@ users = Table(
     Column('email', String(50)),
     Column('email_verified_at', DateTime(timezone=True)),
     Column('image_url', String(255)),
+    Index('users_email_key', 'email', unique=True),
 )
 
 credentials = Table(
@@ -20,6 +21,8 @@ credentials = Table(
     Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE')),
     Column('username', String(255), nullable=False),
     Column('password', String(255), nullable=False),
+    Index('credentials_username_key', 'username', unique=True),
+    Index('credentials_user_id_idx', 'user_id'),
 )
 
 accounts = Table(
@@ -37,4 +40,6 @@ accounts = Table(
     Column('session_state', Text),
     Column('token_type', Text),
     Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE')),
-)
\ No newline at end of file
+    Index('accounts_provider_account_id_key', 'account_provider', 'account_id', unique=True),
+    Index('accounts_user_id_idx', 'user_id'),
+)
@@ -0,0 +1,134 @@
+from typing import Any, Optional, Sequence
+
+from sqlalchemy import Integer, String, ARRAY, and_, func
+from sqlalchemy.sql import Executable, select, insert, update, delete, bindparam, any_
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+from sqlalchemy.ext.asyncio import AsyncSession
+from auth.schemas import accounts, users, credentials
+
+DIALECT = PGDialect_asyncpg()
+
+class Statement:
+    def __init__(self, statement: Executable):
+        self.statement = statement
+        compiled = statement.compile(dialect=DIALECT)
+        self.sql = str(compiled)
+        self.parameters = compiled.positiontup
+
+    async def execute(self, session: AsyncSession, **parameters: Any):
+        return await session.execute(self.statement, parameters)
+
+    async def fetch(self, session: AsyncSession, **parameters: Any) -> Sequence[Sequence[Any]]:
+        # Reads on asyncpg send the precompiled SQL as driver SQL, so nothing is
+        # compiled per call and the dialect's prepared statement cache is used. Going
+        # through the connection keeps SQLAlchemy translating errors, invalidating
+        # broken connections and serializing calls. Writes go through the session so
+        # they join its transaction.
+        connection = await session.connection()
+        if connection.dialect.driver != DIALECT.driver:
+            result = await connection.execute(self.statement, parameters)
+        else:
+            result = await connection.exec_driver_sql(self.sql, tuple(parameters[name] for name in self.parameters))
+        return result.fetchall()
+
+    async def fetchrow(self, session: AsyncSession, **parameters: Any) -> Optional[Sequence[Any]]:
+        rows = await self.fetch(session, **parameters)
+        return rows[0] if rows else None
+
+
+USER_COLUMNS = (
+    users.columns['id'],
+    users.columns['name'],
+    users.columns['email'],
+    users.columns['email_verified_at'],
+    users.columns['image_url']
+)
+
+USER_VALUES = dict(
+    name=bindparam('name'),
+    email=bindparam('email'),
+    email_verified_at=bindparam('email_verified_at'),
+    image_url=bindparam('image_url')
+)
+
+CREATE_USER = Statement(insert(users).values(**USER_VALUES).returning(*USER_COLUMNS))
+
+GET_USER = Statement(select(users).where(users.columns['id'] == bindparam('id')))
+
+GET_USER_BY_EMAIL = Statement(select(users).where(users.columns['email'] == bindparam('email')))
+
+GET_USER_BY_ACCOUNT = Statement(select(users).join(accounts).where(
+    accounts.columns['account_provider'] == bindparam('provider'),
+    accounts.columns['account_id'] == bindparam('account_id')
+))
+
+GET_USERS = Statement(select(users).where(users.columns['id'] == any_(bindparam('ids', type_=ARRAY(Integer)))))
+
+GET_USERS_BY_EMAIL = Statement(select(users).where(users.columns['email'] == any_(bindparam('emails', type_=ARRAY(String)))))
+
+# The requested pairs come in as two arrays of the same length, unnested side by side.
+REQUESTED_ACCOUNTS = func.unnest(
+    bindparam('providers', type_=ARRAY(String)),
+    bindparam('account_ids', type_=ARRAY(String))
+).table_valued('provider', 'id').render_derived(name='requested')
+
+GET_USERS_BY_ACCOUNT = Statement(select(users, accounts.columns['account_provider'], accounts.columns['account_id']).join(accounts).join(REQUESTED_ACCOUNTS, and_(
+    accounts.columns['account_provider'] == REQUESTED_ACCOUNTS.columns['provider'],
+    accounts.columns['account_id'] == REQUESTED_ACCOUNTS.columns['id']
+)))
+
+UPDATE_USER = Statement(update(users).where(users.columns['id'] == bindparam('user_id')).values(**USER_VALUES).returning(*USER_COLUMNS))
+
+DELETE_USER = Statement(delete(users).where(users.columns['id'] == bindparam('id')))
+
+ADD_ACCOUNT = Statement(insert(accounts).values(
+    account_id=bindparam('account_id'),
+    account_type=bindparam('account_type'),
+    account_provider=bindparam('account_provider'),
+    refresh_token=bindparam('refresh_token'),
+    access_token=bindparam('access_token'),
+    expires_at=bindparam('expires_at'),
+    id_token=bindparam('id_token'),
+    scope=bindparam('scope'),
+    session_state=bindparam('session_state'),
+    token_type=bindparam('token_type'),
+    user_id=bindparam('user_id')
+))
+
+ACCOUNT_COLUMNS = ('account_id', 'account_type', 'account_provider', 'refresh_token', 'access_token', 'expires_at', 'id_token', 'scope', 'session_state', 'token_type')
+
+# Inserts a user and links their first account in one statement. The account
+# insert reads the new id from the user insert, and Postgres runs both CTEs even
+# though only the user is selected.
+NEW_USER = insert(users).values(**USER_VALUES).returning(*USER_COLUMNS).cte('new_user')
+
+NEW_ACCOUNT = insert(accounts).from_select(
+    [*ACCOUNT_COLUMNS, 'user_id'],
+    select(*(bindparam(name, type_=accounts.columns[name].type) for name in ACCOUNT_COLUMNS), NEW_USER.columns['id'])
+).cte('new_account')
+
+CREATE_USER_WITH_ACCOUNT = Statement(select(NEW_USER).add_cte(NEW_ACCOUNT))
+
+# Users with their accounts in id order, so each user's rows arrive together and
+# an export can resume after the last id it wrote.
+EXPORT_USERS = Statement(
+    select(*USER_COLUMNS, *(accounts.columns[name] for name in ACCOUNT_COLUMNS))
+    .outerjoin(accounts, accounts.columns['user_id'] == users.columns['id'])
+    .where(users.columns['id'] > bindparam('after'))
+    .order_by(users.columns['id'], accounts.columns['id'])
+)
+
+REMOVE_ACCOUNT = Statement(delete(accounts).where(
+    accounts.columns['account_provider'] == bindparam('provider'),
+    accounts.columns['account_id'] == bindparam('account_id')
+))
+
+ADD_CREDENTIAL = Statement(insert(credentials).values(
+    user_id=bindparam('user_id'),
+    username=bindparam('username'),
+    password=bindparam('password')
+))
+
+GET_CREDENTIAL = Statement(select(credentials).where(credentials.columns['username'] == bindparam('username')))
+
+REMOVE_CREDENTIAL = Statement(delete(credentials).where(credentials.columns['username'] == bindparam('username')))
@@ -0,0 +1,67 @@
+from asyncio import gather
+from typing import Sequence
+
+from aioredis import Redis
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+from auth.keys import Ring, Store
+from auth.statements import GET_USER, GET_USER_BY_EMAIL, GET_USER_BY_ACCOUNT
+from auth.adapters import SESSION_ADD, SESSION_GET, SESSION_UPDATE, SESSION_EXTEND, SESSION_DELETE, SESSION_INDEX
+from auth.adapters import VERIFICATION_ADD, VERIFICATION_USE, VERIFICATION_INVALIDATE
+
+# Connections are opened before a worker reports ready, so the first requests
+# after a deploy do not pay for connecting. The hot reads run once on every
+# Postgres connection, which leaves their types introspected and statements
+# prepared by asyncpg, and the session and verification scripts are loaded on every Redis node.
+
+WARM_STATEMENTS = (
+    (GET_USER, {'id': 0}),
+    (GET_USER_BY_EMAIL, {'email': ''}),
+    (GET_USER_BY_ACCOUNT, {'provider': '', 'account_id': ''}),
+)
+
+SCRIPTS = (
+    SESSION_ADD, SESSION_GET, SESSION_UPDATE, SESSION_EXTEND, SESSION_DELETE, SESSION_INDEX,
+    VERIFICATION_ADD, VERIFICATION_USE, VERIFICATION_INVALIDATE,
+)
+
+async def open_connection(engine: AsyncEngine) -> AsyncConnection:
+    return await engine.connect()
+
+async def warm_connection(connection: AsyncConnection):
+    async with AsyncSession(bind=connection) as session:
+        for statement, parameters in WARM_STATEMENTS:
+            await statement.fetch(session, **parameters)
+
+async def warm_engine(engine: AsyncEngine, connections: int):
+    # The connections are held together so the pool ends up keeping all of them.
+    # Overflow connections are closed when returned, so only the pool size counts.
+    results = await gather(*(open_connection(engine) for _ in range(min(connections, engine.pool.size()))), return_exceptions=True)
+    opened = [result for result in results if isinstance(result, AsyncConnection)]
+    try:
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        await gather(*(warm_connection(connection) for connection in opened))
+    finally:
+        for connection in opened:
+            await connection.close()
+
+async def warm_redis(redis: Redis, connections: int, scripts: Sequence[str] = SCRIPTS):
+    pool = redis.connection_pool
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(await pool.get_connection('PING'))
+    finally:
+        for connection in opened:
+            await pool.release(connection)
+    for script in scripts:
+        await redis.script_load(script)
+
+async def warm_store(store: Store, connections: int):
+    if isinstance(store, Ring):
+        await gather(*(warm_redis(node, connections) for node in store.nodes.values()))
+    elif isinstance(store, Redis):
+        await warm_redis(store, connections)
+    else:
+        await store.initialize()
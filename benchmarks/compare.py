@@ -0,0 +1,31 @@
+import sys
+import json
+from argparse import ArgumentParser
+
+# Compares two result files written by benchmarks.flows and exits with an error
+# when any step got slower than the allowed tolerance.
+
+def compare(baseline: dict, candidate: dict, tolerance: float) -> bool:
+    regressed = False
+    print(f"{'step':<26}{'p50 ms':>18}{'p99 ms':>18}{'req/s':>18}")
+    for step, before in baseline['steps'].items():
+        after = candidate['steps'].get(step)
+        if after is None:
+            continue
+        cells = []
+        for key in ('p50_ms', 'p99_ms', 'throughput'):
+            change = (after[key] - before[key]) / before[key] if before[key] else 0.0
+            worse = change < -tolerance if key == 'throughput' else change > tolerance
+            regressed = regressed or worse
+            cells.append(f"{after[key]:9.2f} {change:+6.0%}{'!' if worse else ' '}")
+        print(f'{step:<26}' + ''.join(f'{cell:>18}' for cell in cells))
+    return regressed
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m benchmarks.compare')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative change before flagging a regression')
+    arguments = parser.parse_args()
+    with open(arguments.baseline) as baseline, open(arguments.candidate) as candidate:
+        sys.exit(1 if compare(json.load(baseline), json.load(candidate), arguments.tolerance) else 0)
@@ -0,0 +1,51 @@
+from time import perf_counter
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from typing import Callable
+
+from auth.models import User, Session, unix_to_datetime
+from auth.adapters import user_from_row, session_from_redis
+from auth.caches import encode_user, decode_user
+
+# Compares building models from storage results with validation, with
+# model_construct and with the trusted hydrators the adapters use, plus decoding
+# a cached user in the old full JSON format and in the compact one.
+
+ROW = (1, 'bench', 'bench@bench.dev', datetime(2030, 1, 1, tzinfo=timezone.utc), 'https://bench.dev/bench.png')
+
+def measure(function: Callable[[], object], iterations: int) -> float:
+    start = perf_counter()
+    for _ in range(iterations):
+        function()
+    return (perf_counter() - start) / iterations * 1e6
+
+def validated_user():
+    return User(id=ROW[0], name=ROW[1], email=ROW[2], email_verified_at=ROW[3], image_url=ROW[4])
+
+def constructed_user():
+    return User.model_construct(id=ROW[0], name=ROW[1], email=ROW[2], email_verified_at=ROW[3], image_url=ROW[4])
+
+def validated_session():
+    return Session(token='bench', user_id=b'1', expires_at=unix_to_datetime(1893456000, tz=timezone.utc))
+
+def main(iterations: int):
+    user = validated_user()
+    old, new = user.model_dump_json(), encode_user(user)
+    results = {
+        'user validated': measure(validated_user, iterations),
+        'user model_construct': measure(constructed_user, iterations),
+        'user trusted': measure(lambda: user_from_row(ROW), iterations),
+        'session validated': measure(validated_session, iterations),
+        'session trusted': measure(lambda: session_from_redis('bench', b'1', 1893456000), iterations),
+        'cached user json object': measure(lambda: User.model_validate_json(old), iterations),
+        'cached user compact': measure(lambda: decode_user(new), iterations),
+    }
+    for name, microseconds in results.items():
+        print(f'{name:<28} {microseconds:8.2f} us/row')
+    print(f'{"cached user size":<28} {len(old):5d} -> {len(new)} bytes')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m benchmarks.hydration')
+    parser.add_argument('--iterations', type=int, default=50000)
+    main(parser.parse_args().iterations)
@@ -0,0 +1,81 @@
+import os
+import asyncio
+from time import perf_counter
+from argparse import ArgumentParser
+from typing import Callable, Dict
+
+from sqlalchemy import make_url
+from sqlalchemy.sql import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from auth.schemas import users, accounts
+from auth.statements import DIALECT, GET_USER, GET_USER_BY_ACCOUNT
+
+# Compares the statement handling the adapters did before statements were
+# prebuilt (construct, cache key, compiled cache lookup on every call) with the
+# prebuilt SQLAlchemy path and the raw asyncpg fast path.
+
+def inline_get_user(id: int):
+    return select(users).where(users.columns['id'] == id)
+
+def inline_get_user_by_account(provider: str, id: str):
+    return select(users).join(accounts).where(
+        accounts.columns['account_provider'] == provider,
+        accounts.columns['account_id'] == id
+    )
+
+def compile_cached(statement, cache: Dict):
+    return statement._compile_w_cache(DIALECT, compiled_cache=cache, column_keys=[], for_executemany=False, schema_translate_map=None)
+
+def measure(function: Callable[[], object], iterations: int) -> float:
+    start = perf_counter()
+    for _ in range(iterations):
+        function()
+    return (perf_counter() - start) / iterations * 1e6
+
+def cpu(iterations: int):
+    cache = {}
+    results = {
+        'get inline': measure(lambda: compile_cached(inline_get_user(1), cache), iterations),
+        'get prebuilt': measure(lambda: compile_cached(GET_USER.statement, cache), iterations),
+        'get raw': measure(lambda: tuple({'id': 1}[name] for name in GET_USER.parameters), iterations),
+        'get_by_account inline': measure(lambda: compile_cached(inline_get_user_by_account('google', '123'), cache), iterations),
+        'get_by_account prebuilt': measure(lambda: compile_cached(GET_USER_BY_ACCOUNT.statement, cache), iterations),
+        'get_by_account raw': measure(lambda: tuple({'provider': 'google', 'account_id': '123'}[name] for name in GET_USER_BY_ACCOUNT.parameters), iterations),
+    }
+    for name, microseconds in results.items():
+        print(f'{name:<28} {microseconds:8.2f} us/call')
+
+
+async def database(url: str, iterations: int):
+    engine = create_async_engine(make_url(url))
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    async with sessionmaker() as session:
+        async def timed(call) -> float:
+            await call()
+            start = perf_counter()
+            for _ in range(iterations):
+                await call()
+            return (perf_counter() - start) / iterations * 1e6
+
+        async def inline():
+            (await session.execute(inline_get_user(1))).fetchone()
+
+        async def prebuilt():
+            (await GET_USER.execute(session, id=1)).fetchone()
+
+        async def raw():
+            await GET_USER.fetchrow(session, id=1)
+
+        for name, call in (('get inline', inline), ('get prebuilt', prebuilt), ('get raw', raw)):
+            print(f'{name:<28} {await timed(call):8.2f} us/call')
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m benchmarks.statements')
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--url', default=os.getenv('DATABASE_URL'), help='Also time full round trips against this database')
+    arguments = parser.parse_args()
+    cpu(arguments.iterations)
+    if arguments.url:
+        asyncio.run(database(arguments.url, arguments.iterations // 10))
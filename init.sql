@@ -1,4 +1,12 @@
-CREATE TABLE users (
+-- Generated by `python -m auth.migrations render`. Add a migration instead of editing this file.
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version VARCHAR(255) PRIMARY KEY,
+    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- 0001_initial
+CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
     name VARCHAR(50),
     email VARCHAR(50),
@@ -6,7 +14,7 @@ CREATE TABLE users (
     image_url VARCHAR(255)
 );
 
-CREATE TABLE credentials (
+CREATE TABLE IF NOT EXISTS credentials (
     id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL,
     username VARCHAR(255) NOT NULL,
@@ -14,7 +22,7 @@ CREATE TABLE credentials (
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
-CREATE TABLE accounts (
+CREATE TABLE IF NOT EXISTS accounts (
     id SERIAL PRIMARY KEY,
     account_id VARCHAR(255) NOT NULL,
     account_type VARCHAR(255) NOT NULL,
@@ -28,4 +36,36 @@ CREATE TABLE accounts (
     token_type TEXT,
     user_id INTEGER NOT NULL,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+INSERT INTO schema_migrations (version) VALUES ('0001_initial');
+
+-- 0002_indexes
+-- no transaction
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM users WHERE email IS NOT NULL GROUP BY email HAVING count(*) > 1) THEN
+        RAISE EXCEPTION 'users has rows sharing an email, merge or remove them before adding the unique index'
+            USING HINT = 'Find them with: SELECT email, array_agg(id) FROM users GROUP BY email HAVING count(*) > 1';
+    END IF;
+    IF EXISTS (SELECT 1 FROM accounts GROUP BY account_provider, account_id HAVING count(*) > 1) THEN
+        RAISE EXCEPTION 'accounts has rows sharing a provider and account id, remove the extra ones before adding the unique index'
+            USING HINT = 'Find them with: SELECT account_provider, account_id, array_agg(id) FROM accounts GROUP BY account_provider, account_id HAVING count(*) > 1';
+    END IF;
+    IF EXISTS (SELECT 1 FROM credentials GROUP BY username HAVING count(*) > 1) THEN
+        RAISE EXCEPTION 'credentials has rows sharing a username, remove the extra ones before adding the unique index'
+            USING HINT = 'Find them with: SELECT username, array_agg(id) FROM credentials GROUP BY username HAVING count(*) > 1';
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_email_key ON users (email);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS accounts_provider_account_id_key ON accounts (account_provider, account_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_id_idx ON accounts (user_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS credentials_username_key ON credentials (username);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS credentials_user_id_idx ON credentials (user_id);
+
+INSERT INTO schema_migrations (version) VALUES ('0002_indexes');
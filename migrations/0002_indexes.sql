@@ -0,0 +1,26 @@
+-- no transaction
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM users WHERE email IS NOT NULL GROUP BY email HAVING count(*) > 1) THEN
+        RAISE EXCEPTION 'users has rows sharing an email, merge or remove them before adding the unique index'
+            USING HINT = 'Find them with: SELECT email, array_agg(id) FROM users GROUP BY email HAVING count(*) > 1';
+    END IF;
+    IF EXISTS (SELECT 1 FROM accounts GROUP BY account_provider, account_id HAVING count(*) > 1) THEN
+        RAISE EXCEPTION 'accounts has rows sharing a provider and account id, remove the extra ones before adding the unique index'
+            USING HINT = 'Find them with: SELECT account_provider, account_id, array_agg(id) FROM accounts GROUP BY account_provider, account_id HAVING count(*) > 1';
+    END IF;
+    IF EXISTS (SELECT 1 FROM credentials GROUP BY username HAVING count(*) > 1) THEN
+        RAISE EXCEPTION 'credentials has rows sharing a username, remove the extra ones before adding the unique index'
+            USING HINT = 'Find them with: SELECT username, array_agg(id) FROM credentials GROUP BY username HAVING count(*) > 1';
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_email_key ON users (email);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS accounts_provider_account_id_key ON accounts (account_provider, account_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_id_idx ON accounts (user_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS credentials_username_key ON credentials (username);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS credentials_user_id_idx ON credentials (user_id);
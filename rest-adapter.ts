@@ -32,6 +32,10 @@ export type Routes = {
     useVerificationToken?: string;
 };
 
+// Returns an id for the browser the adapter is working for, sent as X-Caller-Id so
+// that reads following its writes go to the primary database rather than a replica.
+export type CallerId = () => string | undefined | Promise<string | undefined>;
+
 function handleApiError(error: any): any {
     if (error.response) {
         if (error.response.status === 404) {
@@ -62,7 +66,8 @@ export default function RestAdapter(
         getSessionAndUser: '/users/sessions',
         createVerificationToken: '/users/verification',
         useVerificationToken: '/users/verification/use'
-    }
+    },
+    callerId?: CallerId
 
 ): Adapter {
     let client = axios.create({
@@ -72,6 +77,15 @@ export default function RestAdapter(
           'x-auth-secret': process.env.NEXTAUTH_SECRET || ''
         }
     });
+    if (callerId) {
+        client.interceptors.request.use(async (config) => {
+            let caller = await callerId();
+            if (caller) {
+                config.headers['x-caller-id'] = caller;
+            }
+            return config;
+        });
+    }
 
     return {
 
@@ -180,13 +194,11 @@ export default function RestAdapter(
     
         getSessionAndUser: async (sessionToken: string | undefined) => {
             try {
-                let session = await client.get(`${routes.getSessionAndUser!}/${sessionToken}`);
-                if (!session.data) return null;
-                let userID = session.data.userId;
-                let user = await client.get(`${routes.getUser!}/${userID}`);
-                if (!user.data) return null;
-                let sessionData = { ...session.data, expires: new Date(session.data.expires) };
-                return { session: sessionData, user: user.data } as { session: AdapterSession, user: AdapterUser };
+                let response = await client.get(`${routes.getSessionAndUser!}/${sessionToken}/user`);
+                if (!response.data) return null;
+                let { session, user } = response.data;
+                let sessionData = { ...session, expires: new Date(session.expires) };
+                return { session: sessionData, user: user } as { session: AdapterSession, user: AdapterUser };
             } catch (error) {
                 return handleApiError(error);
             }
@@ -210,4 +222,36 @@ export default function RestAdapter(
             }
         }
     }
-}
\ No newline at end of file
+}
+
+// Creates the user, links their account and starts their session in one call,
+// for first time OAuth sign ins handled outside the adapter.
+export async function signUp(
+    data: {
+        user: Omit<AdapterUser, 'id'>;
+        account: Omit<AdapterAccount, 'userId'>;
+        session?: { sessionToken: string; expires: Date };
+    },
+    backendUrl: string = 'http://0.0.0.0:8000/auth',
+    route: string = '/users/signup',
+    callerId?: CallerId
+) {
+    try {
+        let caller = callerId ? await callerId() : undefined;
+        let response = await axios.post(`${backendUrl}${route}`, data, {
+            headers: {
+                'Content-Type': 'application/json',
+                'x-auth-secret': process.env.NEXTAUTH_SECRET || '',
+                ...(caller ? { 'x-caller-id': caller } : {})
+            }
+        });
+        let { user, account, session } = response.data;
+        return {
+            user: user as AdapterUser,
+            account: mapExpiresAt(account) as AdapterAccount,
+            session: session ? { ...session, expires: new Date(session.expires) } as AdapterSession : null,
+        };
+    } catch (error) {
+        return handleApiError(error);
+    }
+}
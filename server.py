@@ -0,0 +1,50 @@
+import os
+from argparse import ArgumentParser
+from importlib.util import find_spec
+
+import uvicorn
+
+# Production entry point. Every worker is its own process that imports api and
+# builds its own pools in the lifespan. Workers are restarted after serving
+# --max-requests requests, spread by a jitter so they do not all restart at
+# once. On SIGTERM or SIGINT each worker closes its listening socket, waits up
+# to --graceful-timeout seconds for requests in flight and then runs the
+# lifespan shutdown, which flushes and closes everything.
+
+def cpus() -> int:
+    # Honours CPU affinity, as set by taskset or a container's cpuset.
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def workers() -> int:
+    return int(os.getenv('WEB_CONCURRENCY', '0')) or cpus()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python server.py', description='Run the API with one worker per CPU')
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '8000')))
+    parser.add_argument('--workers', type=int, default=workers(), help='Defaults to WEB_CONCURRENCY or the number of usable CPUs')
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('MAX_REQUESTS', '0')), help='Restart a worker after this many requests, 0 to never restart')
+    parser.add_argument('--max-requests-jitter', type=int, default=int(os.getenv('MAX_REQUESTS_JITTER', '0')), help='Random extra requests added to --max-requests per worker')
+    parser.add_argument('--graceful-timeout', type=float, default=float(os.getenv('GRACEFUL_TIMEOUT', '30')), help='Seconds to wait for requests in flight on shutdown')
+    parser.add_argument('--keep-alive', type=int, default=int(os.getenv('KEEP_ALIVE', '5')), help='Seconds to keep idle connections open')
+    parser.add_argument('--backlog', type=int, default=int(os.getenv('BACKLOG', '2048')))
+    arguments = parser.parse_args()
+    uvicorn.run(
+        'api:api',
+        host=arguments.host,
+        port=arguments.port,
+        workers=arguments.workers,
+        loop='uvloop' if find_spec('uvloop') is not None else 'asyncio',
+        http='httptools' if find_spec('httptools') is not None else 'h11',
+        lifespan='on',
+        access_log=False,
+        proxy_headers=True,
+        limit_max_requests=arguments.max_requests or None,
+        limit_max_requests_jitter=arguments.max_requests_jitter,
+        timeout_graceful_shutdown=arguments.graceful_timeout,
+        timeout_keep_alive=arguments.keep_alive,
+        backlog=arguments.backlog,
+    )
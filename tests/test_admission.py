@@ -0,0 +1,158 @@
+import pytest
+import asyncio
+from httpx import AsyncClient, ASGITransport
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+
+from auth.admission import Admission, Limit, CircuitBreaker, Overloaded, route_class, READS, WRITES, SESSIONS, SESSION_USERS, PASSWORDS, EXPORTS, POSTGRES, REDIS, BACKEND_FAILURES
+from auth.memory import MemoryStorage
+from auth.router import router, get_storage, get_admission
+
+def test_route_class():
+    classes = {(method, route.path): route_class(method, route.path) for route in router.routes if isinstance(route, APIRoute) for method in route.methods}
+    assert classes[("GET", "/metrics")] is None
+    assert classes[("GET", "/users/{user_id}")] == READS
+    assert classes[("POST", "/users/batch")] == READS
+    assert classes[("GET", "/users/sessions/{token}/user")] == SESSION_USERS
+    assert classes[("POST", "/users")] == WRITES
+    assert classes[("DELETE", "/users/credentials")] == WRITES
+    assert classes[("PATCH", "/users/sessions")] == SESSIONS
+    assert classes[("DELETE", "/users/{user_id}/sessions")] == SESSIONS
+    assert classes[("POST", "/users/credentials/verify")] == PASSWORDS
+    assert classes[("GET", "/users/export")] == EXPORTS
+
+
+@pytest.mark.asyncio
+async def test_limit():
+    limit = Limit(1, queue=1, queue_timeout=0.05)
+    release = asyncio.Event()
+
+    async def hold():
+        async with limit.hold():
+            await release.wait()
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded, match="queue full"):
+        async with limit.hold():
+            pass
+    with pytest.raises(Overloaded, match="queue timeout"):
+        await waiter
+    release.set()
+    await holder
+    async with limit.hold():
+        assert limit.running == 1
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("auth.admission.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, reset_after=5)
+    breaker.failed()
+    assert not breaker.open
+    breaker.failed()
+    with pytest.raises(Overloaded) as rejected:
+        breaker.check()
+    assert rejected.value.retry_after == 5
+
+    now[0] = 106
+    assert breaker.check()
+    with pytest.raises(Overloaded):
+        breaker.check()
+    breaker.failed()
+    with pytest.raises(Overloaded):
+        breaker.check()
+
+    now[0] = 112
+    assert breaker.check()
+    breaker.succeeded()
+    assert not breaker.open and not breaker.check()
+
+
+class FailingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+        async def get(id):
+            self.calls += 1
+            raise ConnectionRefusedError()
+        self.transaction.users.get = get
+
+@pytest.mark.asyncio
+async def test_admission_sheds():
+    storage = FailingStorage()
+    admission = Admission({READS: Limit(4)}, {POSTGRES: CircuitBreaker(threshold=2, reset_after=30)})
+    api = FastAPI()
+    api.include_router(router)
+    api.dependency_overrides[get_storage] = lambda: storage
+    api.dependency_overrides[get_admission] = lambda: admission
+
+    async with AsyncClient(transport=ASGITransport(api), base_url="http://test") as client:
+        for _ in range(3):
+            response = await client.get("/users/1")
+            assert response.status_code == 503
+            assert response.headers["retry-after"] is not None
+        assert storage.calls == 2
+        assert response.headers["retry-after"] == "30"
+
+        response = await client.post("/users", json={"name": "test", "email": "test@test.com"})
+        assert response.status_code == 503
+        response = await client.get("/users/sessions/missing")
+        assert response.status_code == 404
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+
+
+def test_cluster_failures():
+    exceptions = pytest.importorskip("redis.exceptions")
+    admission = Admission({}, {})
+    assert admission.failed_backend(exceptions.ConnectionError(), (POSTGRES,)) == REDIS
+    assert isinstance(exceptions.ClusterDownError("CLUSTERDOWN"), BACKEND_FAILURES)
+
+
+def test_asyncpg_failures():
+    from asyncpg import exceptions
+    assert isinstance(exceptions.ConnectionDoesNotExistError(), BACKEND_FAILURES)
+    assert isinstance(exceptions.TooManyConnectionsError(), BACKEND_FAILURES)
+    assert not isinstance(exceptions.UniqueViolationError(), BACKEND_FAILURES)
+
+@pytest.mark.asyncio
+async def test_session_users_check_redis():
+    breaker = CircuitBreaker(threshold=1, reset_after=30)
+    admission = Admission({}, {REDIS: breaker, POSTGRES: CircuitBreaker()})
+    breaker.failed()
+    with pytest.raises(Overloaded, match="circuit open"):
+        async with admission.admit(SESSION_USERS):
+            pass
+    async with admission.admit(READS):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_export_held_while_streaming():
+    storage = MemoryStorage()
+    limit = Limit(1, queue=0)
+    running = []
+
+    async def export(after=0, batch_size=1000):
+        running.append(limit.running)
+        return
+        yield
+    storage.transaction.users.export = export
+    api = FastAPI()
+    api.include_router(router)
+    api.dependency_overrides[get_storage] = lambda: storage
+    api.dependency_overrides[get_admission] = lambda: Admission({EXPORTS: limit}, {})
+
+    async with AsyncClient(transport=ASGITransport(api), base_url="http://test") as client:
+        response = await client.get("/users/export")
+        assert response.status_code == 200
+        assert running == [1] and limit.running == 0
+
+        async with limit.hold():
+            response = await client.get("/users/export")
+        assert response.status_code == 503
+        assert running == [1]
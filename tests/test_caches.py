@@ -0,0 +1,64 @@
+import pytest
+from time import sleep
+from aioredis import from_url
+from datetime import datetime, timezone
+from auth.models import User
+from auth.caches import NearCache, UsersCache, encode_user, decode_user
+
+def test_near_cache():
+    cache = NearCache(max_entries=2, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", 1, cache.version)
+    cache.set("b", 2, cache.version)
+    assert cache.get("a") == 1
+    cache.set("c", 3, cache.version)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.evictions == 1
+    assert cache.hit_ratio == 3 / 5
+
+    version = cache.version
+    cache.pop("a")
+    cache.set("a", 1, version)
+    assert cache.get("a") is None
+
+    cache.set("d", 4, cache.version, ttl=0.01)
+    sleep(0.02)
+    assert cache.get("d") is None
+
+    cache.active = False
+    assert cache.get("c") is None
+
+
+def test_users_cache_format():
+    user = User(id=1, name="test", email="test@test.com", email_verified_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    cached = decode_user(encode_user(user))
+    assert cached == user
+    assert cached.model_dump(by_alias=True) == user.model_dump(by_alias=True)
+    assert decode_user(user.model_dump_json()) == user
+
+    unverified = User(id=2, name="test", email="other@test.com")
+    assert decode_user(encode_user(unverified)) == unverified
+
+
+@pytest.mark.asyncio
+async def test_users_cache_generation():
+    redis = from_url("redis://localhost")
+    cache = UsersCache(redis, prefix="test-users")
+    user = User(id=1, name="test", email="test@test.com")
+    await cache.remove(user.id)
+
+    cached, stale = await cache.lookup(cache.id_key(user.id))
+    assert cached is None
+    await cache.remove(user.id)
+    assert not await cache.add(user, generation=stale)
+    assert await cache.get_by_email(user.email) is None
+
+    _, generation = await cache.lookup(cache.id_key(user.id))
+    assert await cache.add(user, cache.account_key("test", "123"), generation=generation)
+    assert await cache.get_by_account("test", "123") == user
+    await cache.remove(user.id)
+    assert await cache.get_by_id(user.id) is None
+    await redis.delete(cache.generation_key())
+    await redis.close()
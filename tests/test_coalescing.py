@@ -0,0 +1,66 @@
+import pytest
+import asyncio
+from auth.coalescing import Coalescer
+from auth.models import User
+
+@pytest.mark.asyncio
+async def test_coalescer():
+    coalescer = Coalescer("test")
+    calls = []
+
+    async def lookup(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    results = await asyncio.gather(*(coalescer.run("key", lambda: lookup(1)) for _ in range(5)), coalescer.run("other", lambda: lookup(2)))
+    assert results == [1, 1, 1, 1, 1, 2]
+    assert calls == [1, 2]
+    assert coalescer.coalesced.value == 4
+    assert coalescer.calls == {}
+
+    assert await coalescer.run("key", lambda: lookup(3)) == 3
+
+
+@pytest.mark.asyncio
+async def test_coalescer_copies():
+    coalescer = Coalescer("test")
+
+    async def lookup():
+        await asyncio.sleep(0.01)
+        return User(id=1, name="test", email="test@test.com")
+
+    first, second = await asyncio.gather(coalescer.run("key", lookup), coalescer.run("key", lookup))
+    assert first == second and first is not second
+    second.name = "changed"
+    assert first.name == "test"
+
+
+@pytest.mark.asyncio
+async def test_coalescer_failures():
+    coalescer = Coalescer("test")
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(*(coalescer.run("key", failing) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert coalescer.calls == {}
+
+    async def slow(value):
+        await asyncio.sleep(0.05)
+        return value
+
+    leader = asyncio.create_task(coalescer.run("key", lambda: slow(1)))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(coalescer.run("key", lambda: slow(2)))
+    impatient = asyncio.create_task(coalescer.run("key", lambda: slow(3)))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    impatient.cancel()
+    assert await follower == 2
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+    with pytest.raises(asyncio.CancelledError):
+        await impatient
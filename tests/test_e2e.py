@@ -1,19 +1,28 @@
 import pytest
+import json
 from typing import AsyncGenerator
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.ext.asyncio import async_sessionmaker
-from aioredis import Redis
 from httpx import AsyncClient
 from httpx import ASGITransport
 from fastapi import FastAPI
-from auth.router import router, get_session_maker, get_redis
+from auth.router import router, get_session_maker, get_redis, get_storage
+from auth.memory import MemoryStorage
+
+# Every test runs against Postgres and Redis and against the in-memory storage.
+
+@pytest.fixture(params=["sql", "memory"])
+def overrides(request: pytest.FixtureRequest) -> dict:
+    if request.param == "memory":
+        storage = MemoryStorage()
+        return {get_storage: lambda: storage}
+    sessionmaker = request.getfixturevalue("sessionmaker")
+    redis = request.getfixturevalue("redis")
+    return {get_redis: lambda: redis, get_session_maker: lambda: sessionmaker}
 
 @pytest.fixture
-async def client(sessionmaker: async_sessionmaker[AsyncSession], redis: Redis) -> AsyncGenerator[AsyncClient, None]:
+async def client(overrides: dict) -> AsyncGenerator[AsyncClient, None]:
     api = FastAPI()
     api.include_router(router)
-    api.dependency_overrides[get_redis] = lambda: redis
-    api.dependency_overrides[get_session_maker] = lambda: sessionmaker
+    api.dependency_overrides.update(overrides)
 
     async with AsyncClient(transport=ASGITransport(api), base_url="http://test") as client:
         yield client
@@ -63,6 +72,23 @@ async def test_users(client: AsyncClient):
     response = await client.get(f"/users/emails/{user['email']}")
     assert response.status_code == 404
 
+@pytest.mark.asyncio
+async def test_msgpack(client: AsyncClient):
+    msgpack = pytest.importorskip("msgpack")
+
+    response = await client.post("/users", json={
+        "name": "test", 
+        "email": "test@test.com",
+        "emailVerified": "2026-01-01T00:00:00+00:00"
+    })
+    user = response.json()
+    assert response.headers["content-type"] == "application/json"
+
+    response = await client.get(f"/users/{user['id']}", headers={"Accept": "application/msgpack"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content) == user
+
 @pytest.mark.asyncio
 async def test_accounts(client: AsyncClient):
     
@@ -110,13 +136,99 @@ async def test_accounts(client: AsyncClient):
 
 
 
+@pytest.mark.asyncio
+async def test_sign_up(client: AsyncClient):
+    sign_up = {
+        "user": {"name": "test", "email": "test@test.com", "image": "http://test.com"},
+        "account": {"providerAccountId": "123", "type": "oauth", "provider": "google"},
+        "session": {"sessionToken": "123", "expires": "2030-01-01T00:00:00+00:00"}
+    }
+    response = await client.post("/users/signup", json=sign_up)
+    assert response.status_code == 200
+    result = response.json()
+    user = result["user"]
+    assert user["id"] is not None
+    assert result["account"]["userId"] == user["id"]
+    assert result["session"]["userId"] == user["id"]
+
+    response = await client.get("/users/accounts/google/123")
+    assert response.json() == user
+    response = await client.get("/users/sessions/123/user")
+    assert response.json()["user"] == user
+
+    await client.delete("/users/sessions/123")
+    response = await client.post("/users/signup", json=sign_up)
+    assert response.status_code == 409
+
+
+@pytest.mark.asyncio
+async def test_export(client: AsyncClient):
+    ids = []
+    for n in range(3):
+        response = await client.post("/users", json={"name": "test", "email": f"test{n}@test.com"})
+        ids.append(response.json()["id"])
+    await client.post("/users/accounts", json={"providerAccountId": "1", "type": "oauth", "provider": "google", "userId": ids[0], "access_token": "secret"})
+    await client.post("/users/accounts", json={"providerAccountId": "2", "type": "oauth", "provider": "github", "userId": ids[0]})
+
+    response = await client.get("/users/export", params={"after": ids[0] - 1})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert [user["id"] for user in users] == ids
+    assert sorted(account["providerAccountId"] for account in users[0]["accounts"]) == ["1", "2"]
+    assert users[0]["accounts"][0]["userId"] == ids[0]
+    assert users[1]["accounts"] == []
+    assert all("access_token" not in account for account in users[0]["accounts"])
+
+    response = await client.get("/users/export", params={"after": ids[0] - 1, "tokens": True})
+    accounts = json.loads(response.text.splitlines()[0])["accounts"]
+    assert sorted(account["access_token"] or "" for account in accounts) == ["", "secret"]
+
+    response = await client.get("/users/export", params={"after": ids[1]})
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == ids[2:]
+
+
+@pytest.mark.asyncio
+async def test_users_batch(client: AsyncClient):
+
+    response = await client.post("/users", json={
+        "name": "test", 
+        "email": "test@test.com",
+        "image": "http://test.com"
+    })
+    user = response.json()
+
+    response = await client.post("/users/accounts", json={
+        "providerAccountId": "123",
+        "type": "test",
+        "provider": "google",
+        "userId": user["id"]
+    })
+    assert response.status_code == 200
+
+    response = await client.post("/users/batch", json={"ids": [0, user["id"]]})
+    assert response.status_code == 200
+    assert response.json() == [None, user]
+
+    response = await client.post("/users/emails/batch", json={"emails": [user["email"], "none@test.com"]})
+    assert response.status_code == 200
+    assert response.json() == [user, None]
+
+    response = await client.post("/users/accounts/batch", json={"accounts": [
+        {"provider": "google", "providerAccountId": "123"},
+        {"provider": "google", "providerAccountId": "456"}
+    ]})
+    assert response.status_code == 200
+    assert response.json() == [user, None]
+
+
 @pytest.mark.asyncio
 async def test_sessions(client: AsyncClient):
 
     await client.post("/users/sessions", json={
         "sessionToken": "123",
         "userId": 1,
-        "expires": "2026-01-01T00:00:00+00:00"
+        "expires": "2030-01-01T00:00:00+00:00"
     })
     
     response = await client.get("/users/sessions/123")
@@ -124,32 +236,92 @@ async def test_sessions(client: AsyncClient):
     session = response.json()
     assert session["sessionToken"] == "123"
     assert session["userId"] == 1
-    assert session["expires"] == "2026-01-01T00:00:00+00:00"
+    assert session["expires"] == "2030-01-01T00:00:00+00:00"
 
-    session["expires"] = "2027-01-01T00:00:00+00:00"
+    session["expires"] = "2031-01-01T00:00:00+00:00"
     await client.patch("/users/sessions", json=session)
     response = await client.get("/users/sessions/123")
     assert response.status_code == 200
     session = response.json()
-    assert session["expires"] == "2027-01-01T00:00:00+00:00"
+    assert session["expires"] == "2031-01-01T00:00:00+00:00"
 
     await client.delete("/users/sessions/123")
     response = await client.get("/users/sessions/123")
     assert response.status_code == 404
 
 
+@pytest.mark.asyncio
+async def test_session_and_user(client: AsyncClient):
+
+    response = await client.post("/users", json={
+        "name": "test", 
+        "email": "test@test.com",
+        "image": "http://test.com"
+    })
+    assert response.status_code == 200
+    user = response.json()
+
+    await client.post("/users/sessions", json={
+        "sessionToken": "123",
+        "userId": user["id"],
+        "expires": "2030-01-01T00:00:00+00:00"
+    })
+
+    response = await client.get("/users/sessions/123/user")
+    assert response.status_code == 200
+    session_and_user = response.json()
+    assert session_and_user["session"]["sessionToken"] == "123"
+    assert session_and_user["session"]["userId"] == user["id"]
+    assert session_and_user["session"]["expires"] == "2030-01-01T00:00:00+00:00"
+    assert session_and_user["user"] == user
+
+    await client.delete("/users/sessions/123")
+    response = await client.get("/users/sessions/123/user")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_user_sessions(client: AsyncClient):
+    response = await client.post("/users", json={"name": "test", "email": "test@test.com"})
+    user = response.json()
+    for token in ("123", "456"):
+        await client.post("/users/sessions", json={
+            "sessionToken": token,
+            "userId": user["id"],
+            "expires": "2030-01-01T00:00:00+00:00"
+        })
+
+    response = await client.get(f"/users/{user['id']}/sessions")
+    assert response.status_code == 200
+    assert [session["sessionToken"] for session in response.json()] == ["123", "456"]
+
+    await client.delete(f"/users/{user['id']}")
+    response = await client.get("/users/sessions/123")
+    assert response.status_code == 404
+    response = await client.get(f"/users/{user['id']}/sessions")
+    assert response.json() == []
+
+
 @pytest.mark.asyncio
 async def test_verification_tokens(client: AsyncClient):
 
     response = await client.post("/users/verification", json={
         "token": "123",
         "identifier": "test",
-        "expires": "2026-01-01T00:00:00+00:00"
+        "expires": "2030-01-01T00:00:00+00:00"
     })
 
     assert response.status_code == 200
 
     response = await client.post("/users/verification/use", json={
+        "identifier": "other",
+        "token": "123"
+    })
+
+    assert response.status_code == 404
+
+    response = await client.post("/users/verification/use", json={
+        "identifier": "test",
         "token": "123"
     })
 
@@ -157,7 +329,31 @@ async def test_verification_tokens(client: AsyncClient):
     token = response.json()
     assert token["token"] == "123"
     assert token["identifier"] == "test"
-    assert token["expires"] == "2026-01-01T00:00:00+00:00"
+    assert token["expires"] == "2030-01-01T00:00:00+00:00"
+
+    response = await client.post("/users/verification/use", json={
+        "identifier": "test",
+        "token": "123"
+    })
+
+    assert response.status_code == 404
+
+    for value in ("456", "789"):
+        await client.post("/users/verification", json={
+            "token": value,
+            "identifier": "test",
+            "expires": "2030-01-01T00:00:00+00:00"
+        })
+
+    response = await client.delete("/users/verification/test")
+    assert response.status_code == 200
+
+    response = await client.post("/users/verification/use", json={
+        "identifier": "test",
+        "token": "456"
+    })
+
+    assert response.status_code == 404
 
 
 @pytest.mark.asyncio
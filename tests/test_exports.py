@@ -0,0 +1,31 @@
+import io
+import json
+import pytest
+
+from auth.models import Account, UserExport
+from auth.exports import checkpoint, ndjson
+
+def test_checkpoint():
+    lines = b"".join(json.dumps({"id": id, "name": "x" * 40000}).encode() + b"\n" for id in (1, 2, 3))
+    file = io.BytesIO(lines + b'{"id": 4, "na')
+    assert checkpoint(file) == 3
+    assert file.getvalue() == lines
+    assert file.tell() == len(lines)
+
+    assert checkpoint(io.BytesIO(lines)) == 3
+    assert checkpoint(io.BytesIO(b'{"id": 1')) == 0
+    assert checkpoint(io.BytesIO(b"")) == 0
+
+
+@pytest.mark.asyncio
+async def test_ndjson_tokens():
+    user = UserExport(id=1, name="test", email="test@test.com", accounts=[
+        Account(id="1", type="oauth", provider="google", user_id=1, access_token="secret", scope="email")
+    ])
+    async def users():
+        yield user
+
+    line = json.loads(b"".join([chunk async for chunk in ndjson(users())]))
+    assert "access_token" not in line["accounts"][0] and line["accounts"][0]["scope"] == "email"
+    line = json.loads(b"".join([chunk async for chunk in ndjson(users(), tokens=True)]))
+    assert line["accounts"][0]["access_token"] == "secret"
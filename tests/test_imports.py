@@ -0,0 +1,70 @@
+import pytest
+import json
+import asyncpg
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from auth.models import Credential
+from auth.adapters import Users, Credentials
+from auth.imports import Importer, read_batches
+
+LINES = [
+    json.dumps({
+        "name": "test", 
+        "email": "test@test.com", 
+        "image": "http://test.com",
+        "accounts": [{"providerAccountId": "123", "type": "oauth", "provider": "google"}],
+        "credentials": [{"username": "test", "password": "test"}]
+    }),
+    "",
+    json.dumps({"name": "test2", "email": "test2@test.com"}),
+]
+
+def test_read_batches():
+    batches = list(read_batches(LINES, 1))
+    assert len(batches) == 2
+    assert batches[0][0].accounts[0].provider == "google"
+    assert batches[1][0].credentials == []
+
+
+@pytest.mark.asyncio
+async def test_importer(connection: AsyncConnection, session: AsyncSession):
+    await connection.execute(text("SELECT 1"))
+    raw = await connection.get_raw_connection()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        importer = Importer(raw.driver_connection, executor)
+        for batch in read_batches(LINES, 10):
+            ids = await importer.load(batch, await importer.hash(batch))
+    assert (importer.users, importer.accounts, importer.credentials) == (2, 1, 1)
+
+    users = Users(session)
+    user = await users.get_by_account("google", "123")
+    assert user is not None
+    assert user.id == ids[0]
+    assert user.email == "test@test.com"
+    assert (await users.get(ids[1])).name == "test2"
+    assert await Credentials(session).verify(Credential(username="test", password="test"))
+
+
+@pytest.mark.asyncio
+async def test_importer_run(connection: AsyncConnection, session: AsyncSession):
+    await connection.execute(text("SELECT 1"))
+    raw = await connection.get_raw_connection()
+    duplicate = json.dumps({"name": "duplicate", "email": "test2@test.com"})
+    last = json.dumps({"name": "test3", "email": "test3@test.com"})
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        importer = Importer(raw.driver_connection, executor)
+        with pytest.raises(asyncpg.UniqueViolationError):
+            await importer.run([*LINES, duplicate, last], batch_size=1)
+        assert importer.imported == 2
+
+        resumed = Importer(raw.driver_connection, executor)
+        await resumed.run([*LINES, json.dumps({"name": "fixed", "email": "fixed@test.com"}), last], batch_size=1, skip=importer.imported)
+    assert (resumed.users, resumed.imported) == (2, 4)
+
+    users = Users(session)
+    assert (await users.get_by_email("test2@test.com")).name == "test2"
+    assert await users.get_by_email("fixed@test.com") is not None
+    assert await users.get_by_email("test3@test.com") is not None
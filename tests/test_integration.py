@@ -1,12 +1,15 @@
 import pytest
+import asyncio
 from datetime import datetime
 from datetime import timezone
 
-from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.models import Session, Account, User, VerificationToken, Credential
-from auth.adapters import Sessions, Accounts, Users, VerificationTokens, Credentials
+from auth.adapters import Sessions, Accounts, Users, VerificationTokens, Credentials, SessionsAndUsers, SlidingExpiry
+from aioredis import from_url
+from auth.caches import UsersCache, NearCache, Invalidations
+from auth.keys import KEYS
 
 @pytest.mark.asyncio
 async def test_sessions(redis):
@@ -14,7 +17,7 @@ async def test_sessions(redis):
     session = Session(
         token="123",
         user_id=1,
-        expires_at=datetime(2026, 1, 1, tzinfo=timezone.utc)
+        expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc)
     )
 
     await sessions.add(session)
@@ -25,7 +28,7 @@ async def test_sessions(redis):
     json = session.model_dump(by_alias=True) 
     assert json["sessionToken"] == "123"
     assert json["userId"] == 1
-    assert json["expires"] == "2026-01-01T00:00:00+00:00"
+    assert json["expires"] == "2030-01-01T00:00:00+00:00"
 
     await sessions.delete("123")
     assert await sessions.get("123") is None
@@ -61,6 +64,151 @@ async def test_users(session):
     assert await users.get(user.id) is None
 
 
+@pytest.mark.asyncio
+async def test_sessions_legacy_format(redis):
+    sessions = Sessions(redis)
+    key = KEYS.session("legacy")
+    await redis.set(key, 1, ex=3600)
+    session = await sessions.get("legacy")
+    assert session is not None
+    assert session.user_id == 1
+    assert await redis.type(key) == b"hash"
+    assert await sessions.get("legacy") == session
+
+    await redis.set(key, 1, ex=3600)
+    session.expires_at = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    await sessions.update(session)
+    assert await sessions.get("legacy") == session
+    await sessions.delete("legacy")
+
+
+@pytest.mark.asyncio
+async def test_sessions_by_user(redis):
+    sessions = Sessions(redis)
+    first = Session(token="first", user_id=7, expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    second = Session(token="second", user_id=7, expires_at=datetime(2030, 1, 2, tzinfo=timezone.utc))
+    other = Session(token="other", user_id=8, expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    for session in (first, second, other):
+        await sessions.add(session)
+
+    assert await sessions.get_by_user(7) == [first, second]
+    await sessions.delete("first")
+    assert await sessions.get_by_user(7) == [second]
+
+    await redis.delete(KEYS.session("second"))
+    assert await sessions.get_by_user(7) == []
+    assert await redis.zcard(KEYS.user_sessions(7)) == 0
+
+    await sessions.add(first)
+    await sessions.add(second)
+    assert await sessions.delete_by_user(7) == 2
+    assert await sessions.get("first") is None
+    assert await sessions.get("second") is None
+    assert await sessions.get("other") == other
+    await sessions.delete("other")
+
+
+def test_sliding_expiry_defer():
+    sliding = SlidingExpiry(from_url("redis://localhost"), threshold=3600, interval=10, max_entries=2)
+    far = int(datetime(2030, 1, 1, tzinfo=timezone.utc).timestamp())
+    assert not sliding.defer("unknown", far)
+    sliding.seen("near", int(datetime.now(timezone.utc).timestamp()) + 60)
+    assert not sliding.defer("near", far)
+
+    sliding.seen("far", far)
+    assert sliding.defer("far", far + 10)
+    assert sliding.defer("far", far + 5)
+    assert sliding.pending == {"far": far + 10}
+    session = Session(token="far", user_id=1, expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    assert sliding.current(session).expires_at == datetime.fromtimestamp(far + 10, timezone.utc)
+    sliding.seen("far", far)
+    assert sliding.pending == {"far": far + 10}
+    sliding.seen("far", far + 10)
+    assert sliding.pending == {}
+    assert sliding.defer("far", far + 20)
+
+    sliding.seen("other", far)
+    sliding.seen("another", far)
+    assert "far" not in sliding.expiries and sliding.pending == {}
+    with pytest.raises(ValueError):
+        SlidingExpiry(from_url("redis://localhost"), threshold=10, interval=10)
+
+@pytest.mark.asyncio
+async def test_sliding_expiry(redis):
+    sliding = SlidingExpiry(redis, threshold=3600, interval=10)
+    sessions = Sessions(redis, sliding=sliding)
+    session = Session(token="sliding", user_id=9, expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    await sessions.add(session)
+
+    session.expires_at = datetime(2030, 1, 2, tzinfo=timezone.utc)
+    await sessions.update(session)
+    assert await redis.hget(KEYS.session("sliding"), "expires_at") == str(int(datetime(2030, 1, 1, tzinfo=timezone.utc).timestamp())).encode()
+    assert (await sessions.get("sliding")).expires_at == session.expires_at
+
+    await sliding.stop()
+    assert await Sessions(redis).get("sliding") == session
+    assert await Sessions(redis).get_by_user(9) == [session]
+
+    await sessions.update(Session(token="sliding", user_id=9, expires_at=datetime(2030, 1, 3, tzinfo=timezone.utc)))
+    await sessions.delete("sliding")
+    await sliding.flush()
+    assert await redis.exists(KEYS.session("sliding")) == 0
+
+
+@pytest.mark.asyncio
+async def test_sessions_near_cache(redis):
+    cache = NearCache(max_entries=10, ttl=60)
+    invalidations = Invalidations(redis, [cache], prefix=KEYS.session(''))
+    await invalidations.start()
+    while not cache.active:
+        await asyncio.sleep(0.01)
+
+    sessions = Sessions(redis, cache)
+    session = Session(
+        token="123",
+        user_id=1,
+        expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc)
+    )
+    await sessions.add(session)
+    assert await sessions.get("123") == session
+    assert await sessions.get("123") == session
+    assert cache.hits == 1
+
+    await Sessions(redis).delete("123")
+    for _ in range(100):
+        if cache.get("123") is None:
+            break
+        await asyncio.sleep(0.01)
+    assert await sessions.get("123") is None
+    await invalidations.stop()
+
+
+@pytest.mark.asyncio
+async def test_sessions_and_users(redis, session: AsyncSession):
+    users = Users(session)
+    user = await users.create(User(
+        name="test",
+        email="test@test.com",
+        image_url="http://test.com"
+    ))
+
+    sessions = Sessions(redis)
+    await sessions.add(Session(
+        token="123",
+        user_id=user.id,
+        expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc)
+    ))
+
+    sessions_and_users = SessionsAndUsers(redis, session)
+    session_and_user = await sessions_and_users.get("123")
+    assert session_and_user is not None
+    assert session_and_user.session.user_id == user.id
+    assert session_and_user.user == user
+
+    await sessions.delete("123")
+    assert await sessions_and_users.get("123") is None
+
+
 @pytest.mark.asyncio
 async def test_accounts(session: AsyncSession):
     users = Users(session)
@@ -94,25 +242,103 @@ async def test_accounts(session: AsyncSession):
     assert user is None
 
 
+@pytest.mark.asyncio
+async def test_create_user_with_account(session: AsyncSession):
+    users = Users(session)
+    user = await users.create_with_account(
+        User(name="test", email="test@test.com"),
+        Account(id="123", type="oauth", provider="test", user_id=0)
+    )
+    assert user.id is not None
+    assert user.email == "test@test.com"
+    assert await users.get_by_account("test", "123") == user
+
+
+@pytest.mark.asyncio
+async def test_users_batch(session: AsyncSession):
+    users = Users(session)
+    accounts = Accounts(session)
+    first = await users.create(User(name="test", email="test@test.com"))
+    second = await users.create(User(name="test2", email="test2@test.com"))
+    await accounts.add(Account(id="123", type="test", provider="test", user_id=second.id))
+
+    assert await users.get_many([second.id, 0, first.id]) == [second, None, first]
+    assert await users.get_many_by_email(["none@test.com", first.email]) == [None, first]
+    assert await users.get_many_by_account([("test", "123"), ("test", "456")]) == [second, None]
+    assert await users.get_many_by_account([]) == []
+
+
+@pytest.mark.asyncio
+async def test_users_cache(redis, session: AsyncSession):
+    cache = UsersCache(redis, ttl=60, prefix="test-users")
+    users = Users(session, cache)
+    accounts = Accounts(session, cache)
+    user = await users.create(User(
+        name="test",
+        email="test@test.com",
+        image_url="http://test.com"
+    ))
+
+    assert await users.get(user.id) == user
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert await users.get(user.id) == user
+    assert await users.get_by_email(user.email) == user
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    user.name = "test2"
+    await users.update(user)
+    assert await cache.get_by_email(user.email) is None
+    assert await users.get(user.id) == user
+
+    await accounts.add(Account(id="123", type="test", provider="test", user_id=user.id))
+    assert await users.get_by_account("test", "123") == user
+    assert await cache.get_by_account("test", "123") == user
+    await accounts.remove("test", "123")
+    assert await cache.get_by_account("test", "123") is None
+
+    after_commit = []
+    renamed = user.model_copy(update={"name": "test3"})
+    await Users(session, cache, after_commit).update(renamed)
+    await cache.add(user)
+    for removal in after_commit:
+        await removal()
+    assert await cache.get_by_id(user.id) is None
+
+    await users.delete(user.id)
+    assert await cache.get_by_id(user.id) is None
+    assert await users.get(user.id) is None
+
+
 @pytest.mark.asyncio
 async def test_verification_tokens(redis):
     verification_tokens = VerificationTokens(redis)
     token = VerificationToken(
         token="123",
         identifier="test",
-        expires_at=datetime(2026, 1, 1, tzinfo=timezone.utc)
+        expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc)
     )
 
     await verification_tokens.add(token)
-    assert await verification_tokens.get("123") == token
+    assert await verification_tokens.get("test", "123") == token
+    assert await verification_tokens.get("other", "123") is None
 
     json = token.model_dump(by_alias=True)
-    assert json["expires"] == "2026-01-01T00:00:00+00:00"
-    token.expires_at = datetime(2026, 1, 2, tzinfo=timezone.utc)
+    assert json["expires"] == "2030-01-01T00:00:00+00:00"
+    token.expires_at = datetime(2030, 1, 2, tzinfo=timezone.utc)
     await verification_tokens.update(token)
-    assert await verification_tokens.get("123") == token
-    await verification_tokens.delete("123")
-    assert await verification_tokens.get("123") is None
+    assert await verification_tokens.get("test", "123") == token
+    await verification_tokens.delete("test", "123")
+    assert await verification_tokens.get("test", "123") is None
+
+    await verification_tokens.add(token)
+    used = await asyncio.gather(*(verification_tokens.use("test", "123") for _ in range(10)))
+    assert [found for found in used if found is not None] == [token]
+
+    for value in ("1", "2", "3"):
+        await verification_tokens.add(VerificationToken(token=value, identifier="test", expires_at=token.expires_at))
+    assert await verification_tokens.invalidate("test") == 3
+    assert await verification_tokens.get("test", "1") is None
+    assert await redis.exists(KEYS.verification_tokens("test")) == 0
 
 
 @pytest.mark.asyncio
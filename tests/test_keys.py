@@ -0,0 +1,179 @@
+import pytest
+import shutil
+import socket
+import asyncio
+import subprocess
+from datetime import datetime, timezone
+from typing import List
+
+from aioredis import from_url
+from aioredis.exceptions import ConnectionError
+from auth.keys import Keys, Ring, tag, hash_tag, route, partition, connect, migrate
+from auth.models import Session, VerificationToken
+from auth.adapters import Sessions, VerificationTokens
+
+def test_hash_tag():
+    assert hash_tag("auth:session:123") == "auth:session:123"
+    assert hash_tag(f"auth:tokens:{tag('a@b.c')}:123") == "a@b.c"
+    assert hash_tag("auth:{}:123") == "auth:{}:123"
+    assert Keys("test").session("123") == "test:session:123"
+    assert Keys("test").verification_token("a@b.c", "123") == "test:verification:{a@b.c}:123"
+    assert hash_tag(Keys().verification_tokens("a@b.c")) == hash_tag(Keys().verification_token("a@b.c", "123"))
+
+
+def test_ring():
+    ring = Ring({"a": "a", "b": "b", "c": "c"})
+    owners = [ring.node(f"auth:session:{n}") for n in range(3000)]
+    assert all(owners.count(name) > 700 for name in "abc")
+    assert ring.node("x:{tag}:1") == ring.node("y:{tag}:2")
+
+    larger = Ring({"c": "c", "a": "a", "b": "b", "d": "d"})
+    moved = [n for n, owner in enumerate(owners) if larger.node(f"auth:session:{n}") != owner]
+    assert all(larger.node(f"auth:session:{n}") == "d" for n in moved)
+    assert len(moved) < 1200
+
+    keys = [f"auth:session:{n}" for n in range(30)]
+    groups = partition(ring, keys)
+    assert sorted(key for group in groups for key in group) == sorted(keys)
+    assert all(len({ring.node(key) for key in group}) == 1 for group in groups)
+
+
+def free_port() -> int:
+    # Cluster nodes also listen on their port plus 10000 for the cluster bus.
+    while True:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        if port < 55536:
+            return port
+
+def start(tmp_path, count: int, *arguments: str) -> List[subprocess.Popen]:
+    if shutil.which("redis-server") is None:
+        pytest.skip("redis-server is not installed")
+    servers = []
+    for _ in range(count):
+        port = free_port()
+        directory = tmp_path / str(port)
+        directory.mkdir()
+        servers.append((port, subprocess.Popen(
+            ["redis-server", "--port", str(port), "--dir", str(directory), "--save", "", "--appendonly", "no", *arguments],
+            stdout=subprocess.DEVNULL
+        )))
+    return servers
+
+async def wait(urls: List[str]):
+    for url in urls:
+        redis = from_url(url)
+        for _ in range(100):
+            try:
+                await redis.ping()
+                break
+            except (OSError, ConnectionError):
+                await asyncio.sleep(0.05)
+        await redis.close()
+
+@pytest.fixture
+async def standalone(tmp_path):
+    servers = start(tmp_path, 3)
+    urls = [f"redis://127.0.0.1:{port}/0" for port, _ in servers]
+    await wait(urls)
+    yield urls
+    for _, process in servers:
+        process.terminate()
+        process.wait()
+
+@pytest.fixture
+async def cluster(tmp_path):
+    pytest.importorskip("redis")
+    servers = start(tmp_path, 3, "--cluster-enabled", "yes", "--cluster-node-timeout", "1000")
+    urls = [f"redis://127.0.0.1:{port}/0" for port, _ in servers]
+    await wait(urls)
+    nodes = [from_url(url) for url in urls]
+    step = 16384 // len(nodes)
+    for index, node in enumerate(nodes):
+        last = 16383 if index == len(nodes) - 1 else (index + 1) * step - 1
+        await node.execute_command("CLUSTER", "ADDSLOTS", *range(index * step, last + 1))
+    for port, _ in servers[1:]:
+        await nodes[0].execute_command("CLUSTER", "MEET", "127.0.0.1", port)
+    for node in nodes:
+        for _ in range(200):
+            if b"cluster_state:ok" in await node.execute_command("CLUSTER", "INFO"):
+                break
+            await asyncio.sleep(0.05)
+        await node.close()
+    yield urls
+    for _, process in servers:
+        process.terminate()
+        process.wait()
+
+
+async def exercise(store):
+    sessions = Sessions(store)
+    tokens = VerificationTokens(store)
+    for n in range(50):
+        session = Session(token=f"token-{n}", user_id=n, expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+        await sessions.add(session)
+        assert await sessions.get(session.token) == session
+        session.expires_at = datetime(2030, 1, 2, tzinfo=timezone.utc)
+        await sessions.update(session)
+        assert await sessions.get(session.token) == session
+        await sessions.delete(session.token)
+        assert await sessions.get(session.token) is None
+
+    added = [Session(token=f"extended-{n}", user_id=n % 5, expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc)) for n in range(50)]
+    for session in added:
+        await sessions.add(session)
+    expires_at = int(datetime(2030, 1, 2, tzinfo=timezone.utc).timestamp())
+    assert await sessions.extend({session.token: expires_at for session in added}) == 50
+    assert len(await sessions.get_by_user(0)) == 10
+    for session in added:
+        assert (await sessions.get(session.token)).expires_at == datetime(2030, 1, 2, tzinfo=timezone.utc)
+        await sessions.delete(session.token)
+
+    for n in range(50):
+        token = VerificationToken(token=f"token-{n}", identifier=f"{n}@test.com", expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+        await tokens.add(token)
+        assert await tokens.get(token.identifier, token.token) == token
+        assert await tokens.use(token.identifier, token.token) == token
+        assert await tokens.use(token.identifier, token.token) is None
+        await tokens.add(token)
+        assert await tokens.invalidate(token.identifier) == 1
+
+@pytest.mark.asyncio
+async def test_ring_store(standalone):
+    ring = connect(standalone)
+    await exercise(ring)
+    assert Sessions(ring).add_script is Sessions(ring).add_script
+    assert VerificationTokens(ring).use_script is VerificationTokens(ring).use_script
+    keys = [Keys().session(f"token-{n}") for n in range(50)]
+    for key in keys:
+        await route(ring, key).set(key, 1)
+    assert all([await node.dbsize() > 0 for node in ring.nodes.values()])
+    await ring.close()
+
+@pytest.mark.asyncio
+async def test_cluster_store(cluster):
+    store = connect(cluster, cluster=True)
+    await exercise(store)
+    await store.close()
+
+@pytest.mark.asyncio
+async def test_migrate(standalone):
+    source = from_url(standalone[0])
+    await source.set("session", 1, ex=3600)
+    await source.hset("hashed", mapping={"user_id": 1, "expires_at": 1893456000})
+    await source.expireat("hashed", 1893456000)
+    await source.set("verification", "test@test.com", ex=3600)
+    await source.set("auth:verification:untagged", "test@test.com", ex=3600)
+    await source.set("users:id:1", "{}")
+    ring = connect(standalone[1:])
+
+    assert await migrate(source, ring) == {"sessions": 2, "verification_tokens": 2}
+    assert await source.exists("session", "hashed", "verification", "auth:verification:untagged") == 0
+    assert await source.exists("users:id:1") == 1
+    assert (await Sessions(ring).get("session")).user_id == 1
+    assert (await Sessions(ring).get("hashed")).expires_at == datetime(2030, 1, 1, tzinfo=timezone.utc)
+    assert (await VerificationTokens(ring).use("test@test.com", "verification")).identifier == "test@test.com"
+    assert (await VerificationTokens(ring).use("test@test.com", "untagged")).identifier == "test@test.com"
+    await source.close()
+    await ring.close()
@@ -0,0 +1,64 @@
+import pytest
+from datetime import datetime, timezone
+
+from auth import memory
+from auth.models import User, Account, Session, VerificationToken
+from auth.memory import Expiring, MemoryStorage
+from auth.ports import Conflict
+
+def test_expiring(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(memory, "time", lambda: now[0])
+    entries = Expiring()
+    entries.set("a", 1010, 1)
+    entries.set("b", 1020, 2)
+    entries.set("c", 990, 3)
+    assert entries.get("c") is None
+
+    for deadline in range(1011, 1200):
+        entries.set("a", deadline, 1)
+    assert len(entries.deadlines) < 70
+
+    now[0] = 1015
+    assert entries.get("a") == (1199, 1)
+    now[0] = 1020
+    assert entries.get("b") is None
+    assert list(entries.entries) == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_memory_storage(monkeypatch):
+    storage = MemoryStorage()
+    async with storage.write() as transaction:
+        user = await transaction.users.create(User(name="test", email="test@test.com"))
+        await transaction.accounts.add(Account(id="1", type="oauth", provider="github", user_id=user.id))
+        with pytest.raises(Conflict):
+            await transaction.users.create(User(name="test", email="test@test.com"))
+        with pytest.raises(Conflict):
+            await transaction.accounts.add(Account(id="1", type="oauth", provider="github", user_id=user.id))
+
+    async with storage.read() as transaction:
+        assert await transaction.users.get_by_account("github", "1") == user
+        found = await transaction.users.get(user.id)
+        found.name = "changed"
+        assert (await transaction.users.get(user.id)).name == "test"
+
+    expires_at = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    await storage.sessions.add(Session(token="1", user_id=user.id, expires_at=expires_at))
+    await storage.sessions.add(Session(token="2", user_id=user.id, expires_at=datetime(2030, 1, 2, tzinfo=timezone.utc)))
+    await storage.verification_tokens.add(VerificationToken(token="1", identifier="test@test.com", expires_at=expires_at))
+    assert [session.token for session in await storage.sessions.get_by_user(user.id)] == ["1", "2"]
+
+    monkeypatch.setattr(memory, "time", lambda: expires_at.timestamp())
+    assert [session.token for session in await storage.sessions.get_by_user(user.id)] == ["2"]
+    assert await storage.verification_tokens.get("test@test.com", "1") is None
+    await storage.verification_tokens.add(VerificationToken(token="2", identifier="test@test.com", expires_at=datetime(2030, 1, 2, tzinfo=timezone.utc)))
+    assert storage.verification_tokens.identifiers["test@test.com"] == {"2"}
+    assert await storage.verification_tokens.invalidate("test@test.com") == 1
+    assert await storage.verification_tokens.use("test@test.com", "2") is None
+
+    async with storage.write() as transaction:
+        await transaction.users.delete(user.id)
+        assert await transaction.users.get_by_account("github", "1") is None
+        assert await transaction.sessions_and_users.get("2") is None
+    assert await storage.sessions.delete_by_user(user.id) == 1
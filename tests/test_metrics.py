@@ -0,0 +1,34 @@
+import pytest
+from auth.metrics import Registry, instrumented, ADAPTER_LATENCY, ADAPTER_ERRORS
+
+def test_registry():
+    registry = Registry()
+    requests = registry.counter('requests_total', 'Requests.', ('route',))
+    latency = registry.histogram('latency_seconds', 'Latency.')
+    registry.collect('pool_size', 'Pool size.', lambda: 3)
+    requests.labels('/users').inc()
+    latency.labels().observe(0.002)
+    latency.labels().observe(20)
+
+    text = registry.render()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{route="/users"} 1.0' in text
+    assert 'latency_seconds_bucket{le="0.001"} 0' in text
+    assert 'latency_seconds_bucket{le="0.0025"} 1' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in text
+    assert 'latency_seconds_count 2' in text
+    assert 'pool_size 3.0' in text
+
+
+@pytest.mark.asyncio
+async def test_instrumented():
+
+    @instrumented('test.fail')
+    async def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await fail()
+    assert ADAPTER_ERRORS.labels('test.fail').value == 1
+    assert ADAPTER_LATENCY.labels('test.fail').counts[-1] == 0
+    assert sum(ADAPTER_LATENCY.labels('test.fail').counts) == 1
@@ -0,0 +1,95 @@
+import pytest
+from pathlib import Path
+from datetime import datetime
+from datetime import timezone
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, async_sessionmaker
+
+from auth.models import Account, Credential, User
+from auth.adapters import Accounts, Credentials, Users
+from auth.schemas import metadata
+from auth.statements import GET_USER, GET_USER_BY_EMAIL, GET_USER_BY_ACCOUNT, GET_USERS, GET_USERS_BY_EMAIL, GET_USERS_BY_ACCOUNT, GET_CREDENTIAL
+from auth.migrations import load_migrations, render
+
+def test_init_sql():
+    init = Path(__file__).parent.parent / 'init.sql'
+    assert init.read_text() == render(load_migrations())
+
+
+def test_schemas_indexes():
+    sql = ''.join(migration.sql for migration in load_migrations())
+    for table in metadata.tables.values():
+        for index in table.indexes:
+            statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=postgresql.dialect()))
+            assert statement in sql or statement.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1) in sql
+
+
+def test_no_transaction_migrations():
+    initial, indexes = load_migrations()[:2]
+    assert initial.transaction and not indexes.transaction
+    statements = indexes.statements()
+    assert statements[0].endswith('END $$;')
+    assert all(statement.startswith('CREATE') and 'CONCURRENTLY' in statement for statement in statements[1:])
+
+
+@pytest.mark.asyncio
+async def test_no_sequential_scans(connection: AsyncConnection):
+    await connection.execute(text("""
+        INSERT INTO users (name, email) 
+        SELECT 'seed', 'seed' || n || '@test.com' FROM generate_series(1, 1000) AS n
+    """))
+    await connection.execute(text("""
+        INSERT INTO accounts (account_id, account_type, account_provider, user_id) 
+        SELECT id::text, 'oauth', 'seed', id FROM users WHERE name = 'seed'
+    """))
+    for table in ('users', 'accounts', 'credentials'):
+        await connection.execute(text(f"ANALYZE {table}"))
+    await connection.execute(text("SET LOCAL enable_seqscan = off"))
+
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith('INSERT'):
+            statements.append((statement, parameters))
+    event.listen(connection.sync_connection, 'before_cursor_execute', capture)
+
+    async with async_sessionmaker(connection, expire_on_commit=False, class_=AsyncSession)() as session:
+        users = Users(session)
+        accounts = Accounts(session)
+        credentials = Credentials(session)
+        user = await users.create(User(name="test", email="test@test.com", email_verified_at=datetime(2026, 1, 1, tzinfo=timezone.utc)))
+        await users.get(user.id)
+        await users.get_by_email(user.email)
+        await accounts.add(Account(id="123", type="test", provider="test", user_id=user.id))
+        await users.get_by_account("test", "123")
+        await credentials.add(Credential(user_id=user.id, username="test", password="test"))
+        await credentials.verify(Credential(username="test", password="test"))
+        await users.update(user)
+        await accounts.remove("test", "123")
+        await credentials.remove(Credential(username="test", password="test"))
+        await users.delete(user.id)
+
+    event.remove(connection.sync_connection, 'before_cursor_execute', capture)
+    # Deleting a user cascades through the foreign keys, which EXPLAIN does not show.
+    statements.append(("DELETE FROM accounts WHERE user_id = $1", (user.id,)))
+    statements.append(("DELETE FROM credentials WHERE user_id = $1", (user.id,)))
+    # Reads are also explained from their precompiled SQL, which covers the
+    # batch lookups the flow above does not run.
+    for statement, parameters in (
+        (GET_USER, {'id': user.id}),
+        (GET_USER_BY_EMAIL, {'email': user.email}),
+        (GET_USER_BY_ACCOUNT, {'provider': 'test', 'account_id': '123'}),
+        (GET_USERS, {'ids': [user.id]}),
+        (GET_USERS_BY_EMAIL, {'emails': [user.email]}),
+        (GET_USERS_BY_ACCOUNT, {'providers': ['test'], 'account_ids': ['123']}),
+        (GET_CREDENTIAL, {'username': 'test'}),
+    ):
+        statements.append((statement.sql, tuple(parameters[name] for name in statement.parameters)))
+
+    assert len(statements) > 8
+    for statement, parameters in statements:
+        result = await connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+        plan = '\n'.join(row[0] for row in result)
+        assert 'Seq Scan' not in plan, f"{statement}\n{plan}"
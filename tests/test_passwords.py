@@ -0,0 +1,40 @@
+import pytest
+import asyncio
+from time import sleep
+from auth.passwords import PasswordHasher
+
+@pytest.mark.asyncio
+async def test_password_hasher():
+    hasher = PasswordHasher(workers=2)
+    hash = await hasher.hash("test")
+    assert await hasher.verify("test", hash)
+    assert not await hasher.verify("test2", hash)
+    assert hasher.completed == 3
+    hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_password_hasher_limits():
+    hasher = PasswordHasher(workers=1, timeout=0.05)
+    task = asyncio.create_task(hasher.run(sleep, 0.5))
+    await asyncio.sleep(0.01)
+    assert hasher.running == 1
+    with pytest.raises(asyncio.TimeoutError):
+        await task
+    assert hasher.running == 1
+
+    queued = asyncio.create_task(hasher.run(sleep, 0))
+    await asyncio.sleep(0.01)
+    assert hasher.waiting == 1
+    with pytest.raises(asyncio.TimeoutError):
+        await queued
+    assert hasher.waiting == 0
+    assert hasher.timeouts == 2
+
+    for _ in range(100):
+        if hasher.running == 0:
+            break
+        await asyncio.sleep(0.01)
+    assert hasher.completed == 1
+    assert await hasher.run(sleep, 0) is None
+    hasher.shutdown()
@@ -0,0 +1,74 @@
+import pytest
+from types import SimpleNamespace
+from contextlib import asynccontextmanager
+from aioredis import from_url
+from auth.replicas import Replicas, LEAST_BUSY
+from auth.adapters import Storage
+from auth.keys import Keys
+
+def sessionmaker(name: str):
+    @asynccontextmanager
+    async def session():
+        yield name
+    return session
+
+@pytest.mark.asyncio
+async def test_round_robin():
+    replicas = Replicas(sessionmaker("primary"), [sessionmaker("a"), sessionmaker("b")], sticky_for=60)
+    names = []
+    for _ in range(4):
+        async with (await replicas.reader("caller"))() as session:
+            names.append(session)
+    assert names == ["a", "b", "a", "b"]
+
+    await replicas.wrote("caller")
+    async with (await replicas.reader("caller"))() as session:
+        assert session == "primary"
+    async with (await replicas.reader("other"))() as session:
+        assert session == "a"
+
+
+@pytest.mark.asyncio
+async def test_least_busy():
+    replicas = Replicas(sessionmaker("primary"), [sessionmaker("a"), sessionmaker("b")], strategy=LEAST_BUSY)
+    async with (await replicas.reader("caller"))() as first:
+        assert replicas.in_flight == [1, 0]
+        async with (await replicas.reader("caller"))() as second:
+            assert (first, second) == ("a", "b")
+    assert replicas.in_flight == [0, 0]
+
+    await replicas.wrote("caller")
+    async with (await replicas.reader("caller"))() as session:
+        assert session == "a"
+
+@pytest.mark.asyncio
+async def test_sticky_across_workers():
+    redis = from_url("redis://localhost")
+    keys = Keys("test-replicas")
+    await redis.delete(keys.caller_wrote("caller"))
+    first, second = (Replicas(sessionmaker("primary"), [sessionmaker("a")], sticky_for=60, store=redis, keys=keys) for _ in range(2))
+    await first.wrote("caller")
+    await first.wrote("")
+    async with (await second.reader("caller"))() as session:
+        assert session == "primary"
+    async with (await second.reader(""))() as session:
+        assert session == "a"
+    await redis.delete(keys.caller_wrote("caller"))
+    await redis.close()
+
+@pytest.mark.asyncio
+async def test_replica_reads_do_not_fill_users_cache():
+    def bound(name: str):
+        @asynccontextmanager
+        async def session():
+            yield SimpleNamespace(bind=name)
+        return session
+    primary = bound("primary")
+    storage = Storage(primary, from_url("redis://localhost"), replicas=Replicas(primary, [bound("a")], sticky_for=60), caller="caller")
+    async with storage.read() as transaction:
+        assert not transaction.users.fill and not transaction.sessions_and_users.users.fill
+
+    async with storage.write() as transaction:
+        assert transaction.users.fill
+    async with storage.read() as transaction:
+        assert transaction.users.fill and transaction.sessions_and_users.users.fill
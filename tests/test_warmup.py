@@ -0,0 +1,17 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine
+from aioredis import Redis
+
+from auth.warmup import warm_engine, warm_redis, SCRIPTS
+
+@pytest.mark.asyncio
+async def test_warm_engine(engine: AsyncEngine):
+    await warm_engine(engine, 3)
+    assert engine.pool.checkedin() == 3
+    assert engine.pool.checkedout() == 0
+
+@pytest.mark.asyncio
+async def test_warm_redis(redis: Redis):
+    await warm_redis(redis, 3)
+    assert len(redis.connection_pool._available_connections) >= 3
+    assert await redis.script_exists(*[redis.register_script(script).sha for script in SCRIPTS]) == [True] * len(SCRIPTS)